@@ -0,0 +1,302 @@
+"""
+A local stand-in for the gpodder.net webservice and podcast feed hosts
+
+It serves the parts of the Simple and Advanced APIs the plugin uses (toplist,
+suggestions, search, podcast data, subscriptions and device settings) and
+generated feeds of any number of episodes, over keep-alive HTTP/1.1.
+
+Podcast `n` of the directory has its feed at `/feeds/<episodes>/<n>.xml`,
+where the number of episodes cycles through `FEED_SIZES`. Feeds support
+conditional GETs and gzip.
+
+With `rate_limit`, API requests over that many a second are answered with
+429 and a Retry-After, like a throttling webservice.
+
+    server = Server()
+    server.start()
+    Prefs['server'] = server.host
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import gzip
+import hashlib
+import json
+import socket
+import sys
+import threading
+import urlparse
+from StringIO import StringIO
+from collections import Counter
+from time import time
+
+FEED_SIZES = (10, 100, 1000, 5000)
+# Every request for credentials other than these is unauthorized.
+USERNAME = 'bench'
+PASSWORD = 'bench'
+# A 1x1 PNG served for every logo.
+LOGO = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGA'
+    'WjR9awAAAABJRU5ErkJggg=='
+)
+LOGO_ETAG = '"logo"'
+
+
+def podcast(host, n, episodes):
+    return {
+        'url': 'http://%s/feeds/%d/%d.xml' % (host, episodes, n),
+        'title': 'Podcast %d' % n,
+        'description': 'Benchmark podcast %d with %d episodes, about '
+                       'topic %d.' % (n, episodes, n % 7),
+        'website': 'http://%s/podcasts/%d' % (host, n),
+        'subscribers': 10000 - n,
+        'subscribers_last_week': 10000 - n - 1,
+        'mygpo_link': 'http://%s/podcast/%d' % (host, n),
+        'logo_url': 'http://%s/logos/%d.png' % (host, n),
+    }
+
+
+def feed(host, n, episodes):
+    """Generate an RSS feed of the given number of episodes"""
+    items = []
+    for i in range(episodes, 0, -1):
+        items.append(
+            '<item>'
+            '<title>Episode %(i)d</title>'
+            '<guid>http://%(host)s/episodes/%(n)d/%(i)d</guid>'
+            '<pubDate>%(date)s</pubDate>'
+            '<description>&lt;p&gt;Episode %(i)d of podcast %(n)d, in which '
+            'lots of things are talked about at length.&lt;/p&gt;'
+            '</description>'
+            '<itunes:duration>01:%(m)02d:00</itunes:duration>'
+            '<enclosure url="http://%(host)s/media/%(n)d/%(i)d.mp3" '
+            'type="audio/mpeg" length="%(length)d"/>'
+            '</item>' % dict(
+                i=i, n=n, host=host, m=i % 60, length=i * 1000,
+                date='Mon, %02d Jan %d 12:00:00 GMT' % (i % 28 + 1,
+                                                        1990 + i // 28),
+            )
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<rss version="2.0" '
+        'xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">'
+        '<channel><title>Podcast %d</title>'
+        '<link>http://%s/podcasts/%d</link>%s</channel></rss>'
+        % (n, host, n, ''.join(items))
+    )
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, so keep-alive requests aren't held up
+    # by delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def accepts_gzip(self):
+        return 'gzip' in (self.headers.get('Accept-Encoding') or '')
+
+    def send(self, code, body='', content_type='application/json',
+             headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send(200, json.dumps(data))
+
+    def authorized(self):
+        header = self.headers.get('Authorization') or ''
+        if header.startswith('Basic ') and \
+                base64.b64decode(header[6:]) == '%s:%s' % (USERNAME, PASSWORD):
+            return True
+        # Without credentials, urllib2 retries with them after a challenge.
+        self.send(401, headers=[('WWW-Authenticate',
+                                 'Basic realm="gpodder.net"')])
+        return False
+
+    def throttled(self, endpoint):
+        if endpoint in ('feeds', 'logos') or not self.server.throttle():
+            return False
+        self.server.count('throttled')
+        self.send(429, headers=[('Retry-After', '1')])
+        return True
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'requests.json':
+            # Not counted, so benchmarks can tell the plugin's requests apart.
+            with server.lock:
+                return self.send_json(dict(server.requests))
+        if self.throttled(parts[0]):
+            return
+        server.count(parts[0])
+
+        if parts[0] == 'toplist':
+            count = int(parts[1].split('.')[0])
+            self.send_json(server.podcasts[:count])
+        elif parts[0] == 'suggestions':
+            if self.authorized():
+                count = int(parts[1].split('.')[0])
+                self.send_json(server.podcasts[-count:])
+        elif parts[0] == 'search.json':
+            q = query.get('q', [''])[0].lower()
+            self.send_json([p for p in server.podcasts
+                            if q in p['title'].lower() or
+                            q in p['description'].lower()])
+        elif parts[:3] == ['api', '2', 'data']:
+            podcast = server.by_url.get(query.get('url', [''])[0])
+            if podcast is None:
+                self.send(404)
+            else:
+                self.send_json(podcast)
+        elif parts[:3] == ['api', '2', 'subscriptions']:
+            if self.authorized():
+                since = int(query.get('since', ['0'])[0])
+                with server.lock:
+                    self.send_json({
+                        'add': [u for u, t in server.subscribed.items()
+                                if t > since],
+                        'remove': [u for u, t in server.removed.items()
+                                   if t > since],
+                        'timestamp': server.timestamp,
+                    })
+        elif parts[0] == 'feeds':
+            self.send_feed(int(parts[1]), int(parts[2].split('.')[0]))
+        elif parts[0] == 'logos':
+            # Every podcast has the same logo.
+            if self.headers.get('If-None-Match') == LOGO_ETAG:
+                self.send(304, headers=[('ETag', LOGO_ETAG)])
+            else:
+                self.send(200, LOGO, 'image/png',
+                          headers=[('ETag', LOGO_ETAG)])
+        else:
+            self.send(404)
+
+    def do_POST(self):
+        server = self.server
+        parts = self.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else ''
+        if self.throttled(parts[0]):
+            return
+        server.count(parts[0] if parts[0] != 'api' else parts[2])
+        if not self.authorized():
+            return
+        if parts[:3] == ['api', '2', 'subscriptions']:
+            changes = json.loads(data)
+            with server.lock:
+                server.timestamp += 1
+                for url in changes.get('add', []):
+                    server.subscribed[url] = server.timestamp
+                    server.removed.pop(url, None)
+                for url in changes.get('remove', []):
+                    server.removed[url] = server.timestamp
+                    server.subscribed.pop(url, None)
+                self.send_json({'timestamp': server.timestamp,
+                                'update_urls': []})
+        elif parts[:3] == ['api', '2', 'devices']:
+            self.send(200)
+        else:
+            self.send(404)
+
+    def send_feed(self, episodes, n):
+        body, compressed, etag = self.server.feed(episodes, n)
+        if self.headers.get('If-None-Match') == etag:
+            self.send(304, headers=[('ETag', etag)])
+        elif self.accepts_gzip():
+            self.send(200, compressed, 'application/rss+xml',
+                      headers=[('ETag', etag), ('Content-Encoding', 'gzip')])
+        else:
+            self.send(200, body, 'application/rss+xml',
+                      headers=[('ETag', etag)])
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The stand-in webservice, with a directory of `size` podcasts of which the
+    first `subscriptions` are subscribed to
+
+    `requests` counts the requests made per endpoint, and is served at
+    `/requests.json`. Throttled requests are counted as `throttled`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, size=200, subscriptions=20, port=0, rate_limit=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.host = '127.0.0.1:%d' % self.server_port
+        self.lock = threading.Lock()
+        self.podcasts = [podcast(self.host, n, FEED_SIZES[n % len(FEED_SIZES)])
+                         for n in range(size)]
+        self.by_url = dict((p['url'], p) for p in self.podcasts)
+        # Timestamps are in seconds, like the webservice's.
+        self.timestamp = int(time())
+        self.subscribed = dict((p['url'], self.timestamp)
+                               for p in self.podcasts[:subscriptions])
+        self.removed = {}
+        self.feeds = {}
+        self.requests = Counter()
+        self.rate_limit = rate_limit
+        self.window = (0, 0)
+
+    def handle_error(self, request, client_address):
+        # Clients close their pooled connections when they exit.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def throttle(self):
+        """Whether an API request is over the rate limit"""
+        if self.rate_limit is None:
+            return False
+        with self.lock:
+            second, count = self.window
+            if second != int(time()):
+                second, count = int(time()), 0
+            self.window = (second, count + 1)
+            return count >= self.rate_limit
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def feed(self, episodes, n):
+        """Get the body, gzipped body and ETag of a feed"""
+        with self.lock:
+            if (episodes, n) not in self.feeds:
+                body = feed(self.host, n, episodes)
+                buf = StringIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    f.write(body)
+                self.feeds[episodes, n] = (
+                    body, buf.getvalue(),
+                    '"%s"' % hashlib.md5(body).hexdigest())
+            return self.feeds[episodes, n]
+
+    def podcast_with(self, episodes):
+        """Get a podcast whose feed has the given number of episodes"""
+        return next(p for p in self.podcasts
+                    if '/feeds/%d/' % episodes in p['url'])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,386 @@
+"""
+In-process stand-ins for the Plex framework
+
+Plex injects its API into the globals of every plugin module. The plugin
+imports it from `Code.plex_framework_api`, so installing a module of stubs
+under that name lets the plugin be imported and its routes called outside of
+Plex Media Server.
+
+Usage (Python 2.7, run from anywhere):
+
+    import plexstub
+    plexstub.install()
+    import Code
+"""
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import urllib
+from xml.sax.saxutils import escape
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CONTENTS = os.path.join(os.path.dirname(HERE), 'Contents')
+
+
+class Store(object):
+    """
+    Data backed by a directory, like the plugin's Data folder
+
+    Objects are pickled. Plex serializes them its own way, and objects that
+    pickle can't handle (like clients holding url openers) are kept in memory
+    instead.
+    """
+    def __init__(self, path=None):
+        self.path = path or tempfile.mkdtemp(prefix='gpodder-bench-')
+        self.objects = {}
+
+    def file(self, key):
+        return os.path.join(self.path, key)
+
+    def Exists(self, key):
+        return key in self.objects or os.path.exists(self.file(key))
+
+    def Load(self, key):
+        with open(self.file(key), 'rb') as f:
+            return f.read()
+
+    def Save(self, key, data):
+        with open(self.file(key), 'wb') as f:
+            f.write(data)
+
+    def LoadObject(self, key):
+        if key in self.objects:
+            return self.objects[key]
+        return pickle.loads(self.Load(key))
+
+    def SaveObject(self, key, obj):
+        try:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            self.Remove(key)
+            self.objects[key] = obj
+        else:
+            self.objects.pop(key, None)
+            self.Save(key, data)
+
+    def Remove(self, key):
+        self.objects.pop(key, None)
+        if os.path.exists(self.file(key)):
+            os.remove(self.file(key))
+
+    def clear(self):
+        self.remove()
+        os.makedirs(self.path)
+
+    def remove(self):
+        self.objects = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class PersistentDict(dict):
+    """
+    Dict, which returns None for missing keys
+    """
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def Save(self):
+        pass
+
+
+class Logger(object):
+    def __init__(self):
+        self.quiet = True
+        self.records = []
+
+    def log(self, level, message, *args):
+        if args:
+            message = message % args
+        self.records.append((level, message))
+        if not self.quiet:
+            sys.stderr.write('%s: %s\n' % (level, message))
+
+    def __call__(self, message, *args):
+        self.log('INFO', message, *args)
+
+    def Debug(self, message, *args):
+        self.log('DEBUG', message, *args)
+
+    def Info(self, message, *args):
+        self.log('INFO', message, *args)
+
+    def Warn(self, message, *args):
+        self.log('WARN', message, *args)
+
+    def Error(self, message, *args):
+        self.log('ERROR', message, *args)
+
+    def Critical(self, message, *args):
+        self.log('CRITICAL', message, *args)
+
+    def Exception(self, message, *args):
+        self.log('ERROR', message, *args)
+
+
+class Threads(object):
+    """
+    Thread, with daemon threads so a benchmark never waits on timers
+
+    While `held` is a list, created threads are put in it instead of being
+    started, so a benchmark can time the calling thread alone. Timers are
+    not started at all unless `timers` is set.
+    """
+    held = None
+    timers = True
+
+    @classmethod
+    def Create(cls, f, *args, **kwargs):
+        t = threading.Thread(target=f, args=args, kwargs=kwargs)
+        t.daemon = True
+        if cls.held is not None:
+            cls.held.append(t)
+        else:
+            t.start()
+        return t
+
+    @classmethod
+    def hold(cls):
+        cls.held = []
+
+    @classmethod
+    def release(cls, hold=False):
+        """
+        Start the held threads and return them. With `hold`, threads created
+        from now on are held again.
+        """
+        threads, cls.held = cls.held or [], [] if hold else None
+        for t in threads:
+            t.start()
+        return threads
+
+    @classmethod
+    def CreateTimer(cls, interval, f, *args, **kwargs):
+        t = threading.Timer(interval, f, args, kwargs)
+        t.daemon = True
+        if cls.timers:
+            t.start()
+        return t
+
+    @staticmethod
+    def Lock(key=None):
+        return threading.Lock()
+
+    @staticmethod
+    def Event(key=None):
+        return threading.Event()
+
+    @staticmethod
+    def Sleep(seconds):
+        threading.Event().wait(seconds)
+
+
+class Hashes(object):
+    @staticmethod
+    def MD5(s):
+        return hashlib.md5(s).hexdigest()
+
+    @staticmethod
+    def SHA1(s):
+        return hashlib.sha1(s).hexdigest()
+
+
+class Locales(object):
+    """
+    Locale, with the plugin's English strings
+    """
+    def __init__(self):
+        with open(os.path.join(CONTENTS, 'Strings', 'en.json')) as f:
+            text = re.sub(r'^\s*//.*$', '', f.read(), flags=re.M)
+        self.strings = json.loads(text)
+
+    def LocalString(self, key):
+        return self.strings.get(key, key)
+
+    def LocalStringWithFormat(self, key, *args):
+        return self.LocalString(key) % args
+
+
+class Object(object):
+    """
+    A metadata object or container, which keeps its attributes
+    """
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def attributes(self):
+        return dict((k, v) for k, v in vars(self).items() if k != 'objects')
+
+
+class Container(Object):
+    def __init__(self, objects=(), **kwargs):
+        super(Container, self).__init__(**kwargs)
+        self.objects = list(objects)
+
+    def add(self, obj):
+        self.objects.append(obj)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+def object_class(name, base=Object):
+    return type(name, (base,), {})
+
+
+def callback(f, ext=None, **kwargs):
+    """Callback, which encodes its arguments in a path like Plex does"""
+    query = urllib.urlencode(sorted(
+        (k, json.dumps(v) if isinstance(v, (dict, list)) else v)
+        for k, v in kwargs.items()
+    ))
+    return '/:/plugins/callback/%s?%s' % (f.__name__, query)
+
+
+def route(path, method='GET', **kwargs):
+    return lambda f: f
+
+
+def handler(prefix, name, thumb=None, art=None):
+    return lambda f: f
+
+
+def resource(name):
+    return 'resource://%s' % name
+
+
+class Resources(object):
+    @staticmethod
+    def ContentsOfURLWithFallback(url=None, fallback=None):
+        return url or fallback
+
+    @staticmethod
+    def Load(name, binary=True):
+        with open(os.path.join(CONTENTS, 'Resources', name), 'rb') as f:
+            return f.read()
+
+
+class DataObject(Object):
+    def __init__(self, data, mime_type):
+        super(DataObject, self).__init__(data=data, mime_type=mime_type)
+
+
+class Redirect(Object):
+    def __init__(self, url):
+        super(Redirect, self).__init__(url=url)
+
+
+class Datetimes(object):
+    @staticmethod
+    def FromTimestamp(ts):
+        return datetime.datetime.fromtimestamp(ts)
+
+    @staticmethod
+    def Now():
+        return datetime.datetime.now()
+
+
+def framework(data_path=None):
+    """Create the stub API as a dict of global names"""
+    api = dict(
+        Callback=callback,
+        Data=Store(data_path),
+        Datetime=Datetimes,
+        Dict=PersistentDict(),
+        Hash=Hashes,
+        JSON=types.ModuleType('JSON'),
+        Locale=Locales(),
+        Log=Logger(),
+        Network=types.ModuleType('Network'),
+        Prefs={'server': 'gpodder.net', 'device_name': 'Benchmark',
+               'username': '', 'password': ''},
+        R=resource,
+        Resource=Resources,
+        Thread=Threads,
+        handler=handler,
+        route=route,
+        Route=route,
+        AudioCodec=types.ModuleType('AudioCodec'),
+        Container=types.ModuleType('Container'),
+        DataObject=DataObject,
+        Redirect=Redirect,
+        ObjectContainer=object_class('ObjectContainer', Container),
+    )
+    api['JSON'].StringFromObject = json.dumps
+    api['JSON'].ObjectFromString = json.loads
+    api['Network'].Hostname = 'benchmark'
+    api['AudioCodec'].AAC = 'aac'
+    api['AudioCodec'].MP3 = 'mp3'
+    api['Container'].MP4 = 'mp4'
+    api['Container'].MP3 = 'mp3'
+    for name in ('DirectoryObject', 'InputDirectoryObject', 'PrefsObject',
+                 'PopupDirectoryObject', 'TrackObject', 'TVShowObject',
+                 'EpisodeObject', 'MediaObject', 'PartObject'):
+        api[name] = object_class(name)
+    return api
+
+
+def install(data_path=None, libraries=()):
+    """
+    Make the plugin importable as `Code` with the stub API and return the API
+
+    `libraries` are extra paths searched for mygpoclient and podcastparser,
+    for checkouts without the library submodules.
+    """
+    api = framework(data_path)
+    module = types.ModuleType('Code.plex_framework_api')
+    module.__dict__.update(api)
+    sys.modules['Code.plex_framework_api'] = module
+
+    package = types.ModuleType('Code')
+    package.__path__ = [os.path.join(CONTENTS, 'Code')]
+    package.__file__ = os.path.join(CONTENTS, 'Code', '__init__.py')
+    sys.modules['Code'] = package
+
+    paths = [os.path.join(CONTENTS, 'Libraries', 'Shared'),
+             os.path.join(HERE, 'stubs')] + list(libraries)
+    for path in reversed(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return api
+
+
+def render(obj):
+    """
+    Render a container roughly as the XML Plex sends to clients, to measure
+    its size
+    """
+    attributes = ''.join(
+        ' %s="%s"' % (k, escape(unicode(v), {'"': '&quot;'}))
+        for k, v in sorted(obj.attributes().items())
+        if isinstance(v, (basestring, int, long, float, datetime.datetime))
+    )
+    name = type(obj).__name__
+    children = [render(o) for o in getattr(obj, 'objects', None) or ()]
+    children += [render(o) for o in getattr(obj, 'items', None) or ()
+                 if isinstance(o, Object)]
+    children += [render(o) for o in getattr(obj, 'parts', None) or ()
+                 if isinstance(o, Object)]
+    return u'<%s%s>%s</%s>' % (name, attributes, u''.join(children), name)
+
+
+def load():
+    """Run the plugin's package module, as Plex does on startup"""
+    package = sys.modules['Code']
+    with open(package.__file__) as f:
+        code = compile(f.read(), package.__file__, 'exec')
+    exec code in package.__dict__
+    return package
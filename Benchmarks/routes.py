@@ -0,0 +1,218 @@
+"""
+Per-route benchmark of the plugin against a local gpodder.net stand-in
+
+Every scenario runs in a fresh interpreter with empty Data, so its first call
+is cold. It is then called `--runs` more times warm. For each scenario the
+benchmark reports:
+
+* the latency of the cold call and the median and 95th percentile of the warm
+  ones,
+* the net number of objects tracked by the garbage collector that a warm call
+  leaves allocated, and the peak resident memory of the process,
+* the size of the rendered container,
+* the requests made to the stand-in by the cold and the warm calls.
+
+Results can be saved and compared with a later run, to check a change
+against a baseline:
+
+    python2 Benchmarks/routes.py --save before.json
+    python2 Benchmarks/routes.py --baseline before.json
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import urllib2
+from time import time
+
+import mygpo
+import plexstub
+
+SEARCH_QUERY = 'topic 3'
+
+
+def scenarios():
+    names = ['subscriptions', 'toplist', 'search', 'podcast']
+    names += ['episodes/%d' % size for size in mygpo.FEED_SIZES]
+    return names
+
+
+def request_counts(host):
+    return json.load(urllib2.urlopen('http://%s/requests.json' % host))
+
+
+def prepare(host, libraries):
+    api = plexstub.install(libraries=libraries)
+    api['Prefs'].update(server=host, username=mygpo.USERNAME,
+                        password=mygpo.PASSWORD)
+    api['Thread'].timers = False
+    plugin = plexstub.load()
+    app = plugin.app
+    # Prefetches would be counted with the requests of the routes.
+    app.prefetcher.workers = 0
+
+    # Apply the preferences and validate the clients up front.
+    api['Thread'].hold()
+    app.validate_prefs()
+    for thread in api['Thread'].release(hold=True):
+        thread.join()
+    for thread in api['Thread'].release():
+        thread.join()
+    return api, app
+
+
+def route(app, name, host):
+    """Get the call of a scenario"""
+    if name == 'subscriptions':
+        return app.subscriptions
+    if name == 'toplist':
+        return lambda: app.toplist(page=0)
+    if name == 'search':
+        return lambda: app.search(query=SEARCH_QUERY)
+
+    size = int(name.split('/')[1]) if '/' in name else 100
+    url = 'http://%s/feeds/%d/' % (host, size)
+    podcast = next(p for p in json.load(urllib2.urlopen(
+        'http://%s/toplist/1000.json' % host)) if p['url'].startswith(url))
+    key = app.entry_store.put(podcast)
+    if name == 'podcast':
+        return lambda: app.podcast(key=key)
+    return lambda: app.episodes(key=key)
+
+
+def measure(call):
+    gc.collect()
+    gc.disable()
+    try:
+        objects = gc.get_count()[0]
+        start = time()
+        result = call()
+        elapsed = time() - start
+        objects = gc.get_count()[0] - objects
+    finally:
+        gc.enable()
+    return result, elapsed, objects
+
+
+def child(name, host, runs, libraries):
+    api, app = prepare(host, libraries)
+    call = route(app, name, host)
+
+    counts = request_counts(host)
+    result, cold, _ = measure(call)
+    cold_counts = request_counts(host)
+    warm = []
+    objects = []
+    for _ in range(runs):
+        result, elapsed, allocated = measure(call)
+        warm.append(elapsed)
+        objects.append(allocated)
+    warm_counts = request_counts(host)
+    api['Data'].remove()
+
+    def requests(before, after):
+        return sum(after.values()) - sum(before.values())
+
+    json.dump({
+        'cold': cold,
+        'warm': warm,
+        'objects': objects,
+        'payload': len(plexstub.render(result).encode('utf-8')),
+        'items': len(getattr(result, 'objects', ())),
+        'cold_requests': requests(counts, cold_counts),
+        'warm_requests': requests(cold_counts, warm_counts),
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }, sys.stdout)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(result):
+    return {
+        'cold ms': result['cold'] * 1000,
+        'p50 ms': percentile(result['warm'], 0.5) * 1000,
+        'p95 ms': percentile(result['warm'], 0.95) * 1000,
+        'objects': percentile(result['objects'], 0.5),
+        'rss KB': result['maxrss'],
+        'payload B': result['payload'],
+        'items': result['items'],
+        'requests': '%d/%d' % (result['cold_requests'],
+                               result['warm_requests']),
+    }
+
+
+COLUMNS = ('cold ms', 'p50 ms', 'p95 ms', 'objects', 'rss KB', 'payload B',
+           'items', 'requests')
+
+
+def report(summaries, baseline=None):
+    print '%-16s' % 'scenario' + ''.join('%12s' % c for c in COLUMNS)
+    for name in scenarios():
+        if name not in summaries:
+            continue
+        row = summaries[name]
+        print '%-16s' % name + ''.join(
+            ('%12.2f' if isinstance(row[c], float) else '%12s') % row[c]
+            for c in COLUMNS)
+        if baseline and name in baseline:
+            before = baseline[name]
+            print '%-16s' % '  vs baseline' + ''.join(
+                '%+11.0f%%' % (100.0 * (row[c] - before[c]) / before[c])
+                if isinstance(row[c], (int, float)) and before[c] else
+                '%12s' % ''
+                for c in COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--scenario', action='append', choices=scenarios(),
+                        help='run only these scenarios')
+    parser.add_argument('--podcasts', type=int, default=200,
+                        help='podcasts in the stand-in directory')
+    parser.add_argument('--subscriptions', type=int, default=20)
+    parser.add_argument('--save', help='save the results to a file')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--libraries', action='append', default=[],
+                        help='extra path to find mygpoclient and '
+                             'podcastparser in')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--host', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.host, args.runs, args.libraries)
+
+    server = mygpo.Server(size=args.podcasts,
+                          subscriptions=args.subscriptions).start()
+    summaries = {}
+    try:
+        for name in args.scenario or scenarios():
+            command = [sys.executable, os.path.abspath(__file__),
+                       '--child', name, '--host', server.host,
+                       '--runs', str(args.runs)]
+            for path in args.libraries:
+                command += ['--libraries', path]
+            result = json.loads(subprocess.check_output(command))
+            summaries[name] = summarize(result)
+    finally:
+        server.stop()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(summaries, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summaries, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
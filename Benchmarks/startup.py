@@ -0,0 +1,122 @@
+"""
+Cold-start benchmark of the plugin
+
+Each run starts a fresh interpreter, imports the plugin against the stub
+framework and times what Plex does before the first menu is shown: loading
+the package, calling `Start` and rendering `main`. Threads the plugin starts
+are held back until the menu is rendered, then run and timed separately as
+background startup.
+
+The libraries the plugin loads lazily must not be imported before the menu
+is rendered. The benchmark fails if one is, if a route needing a client
+doesn't ask for the preferences when no username is set, or if the median
+time to the first menu is over `--max-ms`.
+
+    python2 Benchmarks/startup.py --runs 20 --max-ms 150
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from time import time
+
+import plexstub
+
+LAZY_MODULES = ('cerealizer', 'mygpoclient', 'podcastparser', 'Code.session')
+
+
+def child(libraries):
+    plexstub.install(libraries=libraries)
+    api = sys.modules['Code.plex_framework_api']
+    api.Thread.timers = False
+    api.Thread.hold()
+
+    t0 = time()
+    plugin = plexstub.load()
+    t1 = time()
+    plugin.Start()
+    t2 = time()
+    plugin.app.main()
+    t3 = time()
+    loaded = [m for m in LAZY_MODULES if m in sys.modules]
+
+    # Threads started in the background (like client validation) would go
+    # to the network, so they are not run.
+    for thread in api.Thread.release(hold=True):
+        thread.join()
+    t4 = time()
+
+    # Without a username, routes that need a client ask for the preferences.
+    alert = plugin.app.subscriptions()
+    prefs_alert = isinstance(alert, plugin.app.AlertContainer) and any(
+        isinstance(o, api.PrefsObject) for o in alert.objects)
+    api.Data.remove()
+
+    json.dump({
+        'import': t1 - t0,
+        'start': t2 - t1,
+        'main': t3 - t2,
+        'first_menu': t3 - t0,
+        'background': t4 - t3,
+        'loaded': loaded,
+        'prefs_alert': prefs_alert,
+    }, sys.stdout)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median time to the first menu is '
+                             'longer')
+    parser.add_argument('--libraries', action='append', default=[],
+                        help='extra path to find mygpoclient and '
+                             'podcastparser in')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.libraries)
+
+    command = [sys.executable, os.path.abspath(__file__), '--child']
+    for path in args.libraries:
+        command += ['--libraries', path]
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.check_output(command)
+        results.append(json.loads(output))
+
+    print '%-12s %9s %9s %9s' % ('phase', 'min ms', 'median ms', 'max ms')
+    for phase in ('import', 'start', 'main', 'first_menu', 'background'):
+        values = [r[phase] * 1000 for r in results]
+        print '%-12s %9.2f %9.2f %9.2f' % (phase, min(values), median(values),
+                                          max(values))
+
+    failed = False
+    loaded = sorted(set(m for r in results for m in r['loaded']))
+    if loaded:
+        print 'Loaded before the first menu: %s' % ', '.join(loaded)
+        failed = True
+    if not all(r['prefs_alert'] for r in results):
+        print 'Routes needing a client did not ask for the preferences'
+        failed = True
+    first_menu = median([r['first_menu'] * 1000 for r in results])
+    if args.max_ms is not None and first_menu > args.max_ms:
+        print 'Median time to the first menu %.2fms is over %.2fms' % (
+            first_menu, args.max_ms)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+"""
+Stand-in for the cerealizer module bundled with the Plex framework
+
+The stub Data pickles objects, so classes only need to be accepted here.
+"""
+registered = {}
+
+
+def register(Class, handler=None, classname=''):
+    classname = classname or '%s.%s' % (Class.__module__, Class.__name__)
+    if classname in registered:
+        raise ValueError('A class named %s is already registered' % classname)
+    registered[classname] = Class
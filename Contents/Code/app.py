@@ -1,14 +1,13 @@
-import cerealizer
-import re
+from httplib import HTTPException
 from time import time
-from urllib2 import HTTPError, urlopen
+from urllib2 import HTTPError
 
-import podcastparser
-from mygpoclient.simple import Podcast
+from httppool import CircuitBreaker, Throttle, Transport
 
 from .plex_framework_api import (
     Callback,
     Data,
+    DataObject,
     Datetime,
     Dict,
     DirectoryObject,
@@ -20,30 +19,32 @@ from .plex_framework_api import (
     Prefs,
     PrefsObject,
     R,
+    Redirect,
     Resource,
     TrackObject,
     TVShowObject,
+    Thread,
     handler,
 )
 from .shortcuts import L, LF
 from .utils import (clear_cache, get_audio_codec_from_mime_type,
-                    get_container_from_audio_codec, get_mime_type_from_ext,
-                    podcast_to_dict)
+                    get_container_from_audio_codec, map_concurrently,
+                    normalize_query, paginate, podcast_to_dict)
+from .artwork import ArtworkCache, TOO_LARGE
+from .cache import Namespaces, SingleFlight, TTLCache
+from .stats import Stats
+from .entries import EntryStore, short_hash
 from .containers import AlertContainer, ErrorContainer, ObjectContainer
-from .exceptions import InvalidPrefsError
+from .feeds import FeedCache
+from .index import EpisodeIndex
+from .search import SearchIndex
+from .prefetch import Prefetcher
+from .subscriptions import SubscriptionJournal, SubscriptionStore
+from .exceptions import FeedError, InvalidPrefsError
 from .decorators import (
     app_route, client_required, public_client_required, use_cache,
 )
 
-from session import (Client, PublicClient, Session, InvalidClientError,
-                     InvalidPublicClientError)
-
-
-cerealizer.register(Podcast)
-cerealizer.register(Client)
-cerealizer.register(PublicClient)
-cerealizer.register(Session)
-
 
 PREFIX = '/music/gpodder'
 NAME = 'gPodder'
@@ -51,64 +52,308 @@ ICON = 'icon-default.png'
 DEVICE_ID = 'plex-gpodder-plugin.%s' % Network.Hostname
 
 TOPLIST_CACHE_TIME = 86400 # one day
+SUGGESTIONS_CACHE_TIME = 21600 # six hours
 SUBSCRIPTIONS_CACHE_TIME = 3600 # one hour
+SEARCH_CACHE_TIME = 3600 # one hour
+# Local search results are shown without remote ones if the directory takes
+# longer than this.
+SEARCH_TIMEOUT = 10 # seconds
+LOCAL_SEARCH_SIZE = 20
+# Cached lists about to expire within this interval are refreshed ahead of
+# time.
+REFRESH_INTERVAL = 600 # ten minutes
+# A summary of the stats is logged this often.
+STATS_LOG_INTERVAL = 3600 # one hour
+# Clients are validated in the background at most this often.
+CLIENT_VALIDATION_TIME = 3600 # one hour
+# Once gpodder.net throttles a request, requests to it are limited to this
+# rate, with bursts of up to API_BURST requests, until they succeed again.
+# Throttled requests are retried up to API_RETRIES times.
+API_RATE = 4 # requests per second
+API_BURST = 8
+API_RETRIES = 4
+# Requests give up on hosts that take longer than this to connect, or to send
+# more data.
+CONNECT_TIMEOUT = 5 # seconds
+READ_TIMEOUT = 20 # seconds
+# Feed hosts are not requested for BREAKER_RESET_TIME after BREAKER_FAILURES
+# failed requests in a row, and then probed with a single request.
+BREAKER_FAILURES = 5
+BREAKER_RESET_TIME = 30 # seconds
+# Caches of this many of the most recently used accounts are kept.
+ACCOUNT_CACHES = 5
+
+EPISODES_PAGE_SIZE = 50
+# Lists of podcasts are fetched whole (up to the most the webservice returns)
+# and paged from the cache.
+LIST_PAGE_SIZE = 20
+TOPLIST_SIZE = 100
+SUGGESTIONS_SIZE = 100
+
+# Podcast data of new subscriptions is fetched concurrently.
+PODCAST_DATA_WORKERS = 8
+PODCAST_DATA_TIMEOUT = 15 # seconds
+
+# Listings of a feed indexed less than this long ago are served from the
+# episode index without revalidating the feed.
+FEED_REFRESH_TIME = 900 # fifteen minutes
+# The cached copy of a feed is listed if fetching it takes longer than this.
+FEED_DEADLINE = 5 # seconds
+
+# Feeds of subscriptions that are due a refresh are fetched concurrently for
+# the recent list.
+RECENT_COUNT = 50
+RECENT_WORKERS = 8
+RECENT_BUDGET = 20 # seconds
+
+# The first podcasts of listed pages are fetched ahead in the background,
+# within this many bytes downloaded per window.
+PREFETCH_WORKERS = 2
+PREFETCH_SIZE = 3
+PREFETCH_MAX_SIZE = 10
+PREFETCH_BUDGET = 10 * 1024 * 1024 # bytes
+PREFETCH_WINDOW = 600 # ten minutes
+
+# The session is loaded on first use, see `get_session`.
+session = None
+session_lock = Thread.Lock()
+stats = Stats()
+# Concurrent requests for the same list are made once.
+flights = SingleFlight()
+# Connections are pooled for all clients and feeds.
+transport = Transport(timeout=READ_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                      throttle=Throttle(API_RATE, API_BURST,
+                                        max_retries=API_RETRIES),
+                      breaker=CircuitBreaker(BREAKER_FAILURES,
+                                             BREAKER_RESET_TIME))
+
+episode_index = EpisodeIndex('episodes', head_size=RECENT_COUNT)
+feed_cache = FeedCache(transport, episode_index)
+artwork_cache = ArtworkCache(transport)
+# Caches of the user's lists are kept per account, see `namespace`.
+namespaces = Namespaces('namespaces', size=ACCOUNT_CACHES)
+subscription_journals = {}
+search_cache = TTLCache('search', size=200, ttl=SEARCH_CACHE_TIME,
+                        disk_size=50)
+entry_store = EntryStore('entry')
+search_index = SearchIndex()
+prefetcher = Prefetcher(lambda item: prefetch_podcast(item),
+                        lambda: feed_cache.wire_bytes,
+                        workers=PREFETCH_WORKERS, size=PREFETCH_SIZE,
+                        max_size=PREFETCH_MAX_SIZE,
+                        max_bytes=PREFETCH_BUDGET, window=PREFETCH_WINDOW)
+
+
+def get_session():
+    """
+    Get the session, loading it on first use
+    """
+    global session
+    if session is None:
+        with session_lock:
+            if session is None:
+                session = load_session()
+    return session
 
-# TODO: See if undocumented Plex Regex() can work
-TITLE_REGEX = re.compile(r'[^\w\d]|the\s')
-AUDIO_URL_REGEX = re.compile(
-    r"""(https?:\/\/                             # scheme
-        (?:[^/\s]+)                              # domain name
-        \/(?:[^\s]*\/)?                          # path
-        (?:[^\s\/]*(?<=[^\/])\.                  # filename
-        (?P<ext>m4[abpvr]|mp[34]|3gp|aac|ogg)))  # extension""",
-    re.VERBOSE,
-)
 
-if Data.Exists('session'):
-    Log.Info('Using cached session')
-    session = Data.LoadObject('session')
-else:
-    session = Session(DEVICE_ID)
+def load_session():
+    # The client library is only imported now, so it doesn't add to startup.
+    # Objects holding its classes are saved in Data, so they are registered
+    # before anything is loaded.
+    import cerealizer
+    from mygpoclient.simple import Podcast
+    from session import Client, PublicClient, Session
+
+    for cls in (Podcast, Client, PublicClient, Session, SubscriptionStore):
+        cerealizer.register(cls)
+    Session.transport = transport
+
+    if Data.Exists('session'):
+        Log.Info('Using cached session')
+        return Data.LoadObject('session')
+    return Session(DEVICE_ID)
+
+
+def namespace():
+    """
+    Get the namespace of the caches of the current account, removing the
+    caches of accounts no longer kept
+    """
+    session = get_session()
+    ns, removed = namespaces.use(getattr(session, 'server', None),
+                                 getattr(session, 'username', None))
+    for old in removed:
+        Log.Info('Removing caches of namespace %s', old)
+        remove_namespace(old)
+    return ns
+
+
+def namespaced(name, ns):
+    # Caches kept before namespaces were have no namespace.
+    return name if ns is None else '%s_%s' % (name, ns)
+
+
+def cache_key(name):
+    """
+    Get the Data or Dict key of a cache of the current account
+    """
+    return namespaced(name, namespace())
+
+
+def subscription_journal():
+    """
+    Get the subscriptions journal of the current account
+    """
+    ns = namespace()
+    journal = subscription_journals.get(ns)
+    if journal is None:
+        journal = subscription_journals.setdefault(
+            ns, SubscriptionJournal(namespaced('subscriptions', ns)))
+    return journal
+
+
+def remove_namespace(ns):
+    journal = subscription_journals.pop(ns, None) or \
+        SubscriptionJournal(namespaced('subscriptions', ns))
+    journal.clear()
+    clear_cache(
+        data_attrs=[namespaced(name, ns)
+                    for name in ('toplist_pages', 'suggestions_pages')
+                    if Data.Exists(namespaced(name, ns))],
+        dict_items=[namespaced(name, ns)
+                    for name in ('subscriptions_accessed',
+                                 'subscriptions_pending', 'toplist_accessed',
+                                 'suggestions_accessed')],
+    )
 
 
 def validate_prefs():
+    session = get_session()
     try:
         # update session properties
         session.server = Prefs['server']
         session.device_name = Prefs['device_name']
         session.username = Prefs['username']
         session.password = Prefs['password']
-        # get/create mygpo clients and clear caches if clients are new
-        _, created = session.get_or_create_public_client()
-        if created:
-            clear_cache(data_attrs=('subscriptions',),
-                        dict_items=('subscriptions_accessed',))
-            Log.Info("public client cache cleared")
-        _, created = session.get_or_create_client()
-        if created:
-            clear_cache(data_attrs=('toplist',),
-                        dict_items=('toplist_accessed',))
-            Log.Info("client cache cleared")
+        # Caches are kept per account, so new clients use those of their
+        # account instead of clearing them.
+        session.get_or_create_public_client()
+        session.get_or_create_client()
+        Log.Info('Using caches of namespace %s', namespace())
         Data.SaveObject('session', session)
     except InvalidPrefsError as e:
-        error_message = e.message
-    except InvalidPublicClientError as e:
-        Log.Warn("%s", e)
-        error_message = L('public client error')
-    except InvalidClientError as e:
-        Log.Warn("%s", e)
-        error_message = L('client error')
-    else:
-        return True
-    return ErrorContainer(error_message, objects=(
-        PrefsObject(title=L('preferences')),
-    ))
+        return ErrorContainer(e.message, objects=(
+            PrefsObject(title=L('preferences')),
+        ))
+    # Neither startup nor a change of preferences waits on the server; routes
+    # use the clients right away and only report invalid preferences once a
+    # call fails for them.
+    Thread.Create(validate_clients)
+    return True
+
+
+def validate_clients():
+    """
+    Validate the clients unless they were validated recently, and send a
+    changed device name to the server.
+    """
+    session = get_session()
+    names = ('public_client', 'client') if session.username else \
+        ('public_client',)
+    for name in names:
+        if session.validate(name, CLIENT_VALIDATION_TIME) is False:
+            Log.Warn('Invalid preferences for the %s', name)
+    session.update_device()
+    Data.SaveObject('session', session)
 
 
 def start():
     ObjectContainer.title1 = NAME
     DirectoryObject.thumb = R(ICON)
-    validate_prefs()
+    # Load the session and apply the preferences off the startup path.
+    Thread.Create(validate_prefs)
+    transport.observer = record_request
+    feed_cache.observer = record_feed
+    transport.breaker.observer = record_circuit
+    Thread.CreateTimer(REFRESH_INTERVAL, refresh_caches)
+    Thread.CreateTimer(STATS_LOG_INTERVAL, log_stats)
+
+
+def record_request(host, seconds, error):
+    # Feeds are timed until they're read, see `record_feed`.
+    kind = 'gpodder.net' if host == Prefs['server'] else 'other hosts'
+    stats.record_request(kind, seconds, error, transport.context.route)
+
+
+def record_feed(url, seconds, error):
+    stats.record_request('feeds', seconds, error, transport.context.route)
+
+
+def record_circuit(host, state):
+    if state == CircuitBreaker.CLOSED:
+        Log.Info('Circuit of %s closed', host)
+    else:
+        Log.Warn('Circuit of %s %s, not requesting it for now', host, state)
+
+
+def stats_lines():
+    caches = {}
+    if search_cache.hits or search_cache.misses:
+        caches['search'] = search_cache.stats()
+    if prefetcher.count:
+        caches['prefetch'] = prefetcher.stats()
+    # Calls that shared the result of one in flight count as hits.
+    for name, flight in (('coalesced lists', flights),
+                         ('coalesced feeds', feed_cache.flights)):
+        if flight.led or flight.shared:
+            caches[name] = flight.stats()
+    lines = stats.lines(caches=caches)
+    throttle = transport.throttle.stats()
+    if throttle['throttled'] or throttle['waited']:
+        lines.append('throttle: %d throttled responses, %.1fs waited' % (
+            throttle['throttled'], throttle['waited']))
+    breaker = transport.breaker.stats()
+    if breaker['trips']:
+        states = sorted(transport.breaker.states().items())
+        lines.append('breakers: %d trips, %d refused requests; %s' % (
+            breaker['trips'], breaker['refused'],
+            ', '.join('%s %s (%d trips)' % (host, state, trips)
+                      for host, (state, trips) in states)))
+    return lines
+
+
+def log_stats():
+    """
+    Log a summary of the stats periodically.
+    """
+    try:
+        for line in stats_lines():
+            Log.Info('Stats: %s', line)
+    finally:
+        Thread.CreateTimer(STATS_LOG_INTERVAL, log_stats)
+
+
+def refresh_caches():
+    """
+    Refresh cached lists in the background before they expire.
+    """
+    from session import ClientError
+
+    session = get_session()
+    try:
+        if session.public_client and \
+                get_toplist.expires_in() < REFRESH_INTERVAL:
+            get_toplist.refresh()
+        if session.client and \
+                get_subscriptions.expires_in() < REFRESH_INTERVAL:
+            get_subscriptions.refresh()
+        if session.client and \
+                get_suggestions.expires_in() < REFRESH_INTERVAL:
+            get_suggestions.refresh()
+    except ClientError as e:
+        Log.Warn('Unable to refresh caches: %s', e)
+    finally:
+        Thread.CreateTimer(REFRESH_INTERVAL, refresh_caches)
 
 
 @handler(PREFIX, NAME, ICON)
@@ -159,37 +404,50 @@ def main():
     ))
 
 
-@use_cache('subscriptions_accessed', SUBSCRIPTIONS_CACHE_TIME)
+@use_cache('subscriptions_accessed', SUBSCRIPTIONS_CACHE_TIME, stale=True)
 def get_subscriptions(use_cache=False):
+    journal = subscription_journal()
     if use_cache:
-        if Data.Exists('subscriptions'):
+        if journal.exists():
             Log.Info('Using cached subscriptions')
-            return Data.LoadObject('subscriptions')
+            return journal.load()
         else:
             return get_subscriptions(use_cache=False)
 
-    since = Dict['subscriptions_accessed'] or 0
-    try:
-        changes = session.client.pull_subscriptions(since)
-    except:
-        return ErrorContainer(L('subscriptions error'))
-    Dict['subscriptions_accessed'] = changes.since
+    session = get_session()
+    subscriptions = journal.load()
+    # Subscriptions that couldn't be read are synced from the start.
+    since = 0 if journal.unreadable else \
+        Dict[cache_key('subscriptions_accessed')] or 0
+    changes = session.client.pull_subscriptions(since)
+    Dict[cache_key('subscriptions_accessed')] = changes.since
 
     Log.Info('Added: %s', changes.add)
     Log.Info('Removed: %s', changes.remove)
 
-    if Data.Exists('subscriptions'):
-        subscriptions = Data.LoadObject('subscriptions')
-    else:
-        subscriptions = []
-    # Remove urls returned from subscriptions changes.
-    subscriptions = [s for s in subscriptions
-                     if s.url not in changes.remove]
-    # Add urls returned from subscriptions changes.
-    subscriptions += [session.public_client.get_podcast_data(url)
-                      for url in changes.add]
-
-    Data.SaveObject('subscriptions', subscriptions)
+    # Fetch data of urls added in subscriptions changes, along with those
+    # whose podcast data could not be fetched during the previous sync.
+    skip = set(changes.remove)
+    pending = []
+    for url in changes.add + (Dict[cache_key('subscriptions_pending')] or []):
+        if url not in subscriptions and url not in skip:
+            skip.add(url)
+            pending.append(url)
+    added, failed = map_concurrently(
+        transport.context.bind(session.public_client.get_podcast_data),
+        pending, workers=PODCAST_DATA_WORKERS, timeout=PODCAST_DATA_TIMEOUT)
+    if failed:
+        Log.Warn('Retrying on next sync: %s', failed)
+    Dict[cache_key('subscriptions_pending')] = failed
+
+    with journal.lock:
+        # Remove urls returned from subscriptions changes.
+        for url in changes.remove:
+            subscriptions.remove(url)
+        for podcast in added:
+            subscriptions.add(podcast)
+        journal.save(subscriptions)
+        journal.unreadable = False
     return subscriptions
 
 
@@ -199,86 +457,161 @@ def update_subscriptions(add_entries=None, remove_entries=None):
     if remove_entries is None:
         remove_entries = ()
 
-    result = session.client.update_subscriptions(
+    from mygpoclient.simple import Podcast
+
+    result = get_session().client.update_subscriptions(
         add_urls=[entry['url'] for entry in add_entries],
         remove_urls=[entry['url'] for entry in remove_entries],
     )
     subscriptions = get_subscriptions(use_cache=True)
 
-    # Add new entries to subscriptions
-    for entry in add_entries:
-        for s in subscriptions:
-            if s.url == entry['url']:
-                break
-        else:
-            subscriptions.append(Podcast.from_dict(entry))
+    journal = subscription_journal()
+    with journal.lock:
+        # Add new entries to subscriptions
+        for entry in add_entries:
+            if entry['url'] not in subscriptions:
+                subscriptions.add(Podcast.from_dict(entry))
 
-    # Update subscriptions who's urls have changed.
-    for old_url, new_url in result.update_urls:
-        for s in subscriptions:
-            if s.url == old_url:
-                s.url = new_url
-                break
+        # Remove entries from subscriptions
+        for entry in remove_entries:
+            subscriptions.remove(entry['url'])
 
-    Data.SaveObject('subscriptions', subscriptions)
+        # Update subscriptions who's urls have changed.
+        for old_url, new_url in result.update_urls:
+            subscriptions.rename(old_url, new_url)
+
+        journal.save(subscriptions)
     return subscriptions
 
 
+def client_error(e, message):
+    """
+    Get the error container of a failed client call, asking the user to try
+    again if the server was throttling requests
+    """
+    from mygpoclient.http import UnknownResponse
+
+    if isinstance(e, UnknownResponse) and e.args[:1] in ((429,), (503,)):
+        return ErrorContainer(L('busy error'))
+    return ErrorContainer(message)
+
+
 @app_route('/recent')
 @client_required
 def recent(container=None):
     """
     List the most-recently-aired episodes in user's subscriptions.
+    Feeds indexed recently are not fetched; feeds that can't be fetched
+    within the time budget are listed as last indexed.
     """
+    from session import Unauthorized
+
+    try:
+        subscriptions = get_subscriptions()
+    except Unauthorized:
+        raise
+    except Exception as e:
+        return client_error(e, L('subscriptions error'))
+    if not len(subscriptions):
+        return AlertContainer(L('recent'), L('no subscriptions'))
+
+    def fetch(url):
+        return feed_cache.fetch(url, count=RECENT_COUNT)
+
+    episode_index.fit(len(subscriptions))
+
+    stale = [s.url for s in subscriptions
+             if time() - episode_index.indexed(s.url) > FEED_REFRESH_TIME]
+    _, failed = map_concurrently(transport.context.bind(fetch), stale,
+                                 workers=RECENT_WORKERS,
+                                 budget=RECENT_BUDGET)
+    if failed:
+        Log.Warn('Unable to refresh feeds of %s', failed)
+
+    podcasts = {s.url: s for s in subscriptions}
+    recent_episodes = episode_index.recent(podcasts, RECENT_COUNT)
+    if not len(recent_episodes):
+        return AlertContainer(L('recent'), L('no episodes'))
+
     if not container:
-        container = ObjectContainer()
+        container = ObjectContainer(no_cache=True)
     container.title2 = L('recent')
+    if failed or get_subscriptions.is_offline():
+        container.title2 = LF('stale', container.title2)
+
+    keys = {}
+    for url, i, e in recent_episodes:
+        p = podcasts[url]
+        if url not in keys:
+            keys[url] = entry_store.put(podcast_to_dict(p))
+        container.add(episode_object(keys[url], e, p.logo_url, i))
     return container
 
 
-@app_route('/subcribe_to', entry=dict)
+@app_route('/subcribe_to')
 @client_required
-def subscribe_to(entry):
+def subscribe_to(key):
+    from session import Unauthorized
+
+    entry = entry_store.get(key)
+    if entry is None:
+        return ErrorContainer(L('entry error'))
     try:
         update_subscriptions(add_entries=(entry,))
+    except Unauthorized:
+        raise
     except:
         return podcast(
-            entry=entry,
+            key=key,
             container=AlertContainer(L('subscriptions'),
                                      L('subscriptions update error')),
         )
     return episodes(
-        entry=entry,
+        key=key,
         container=AlertContainer(L('subscriptions'),
                                  LF('subscribed', entry['title'])),
     )
 
 
-@app_route('/unsubscribe_from', entry=dict)
+@app_route('/unsubscribe_from')
 @client_required
-def unsubscribe_from(entry):
+def unsubscribe_from(key):
+    from session import Unauthorized
+
+    entry = entry_store.get(key)
+    if entry is None:
+        return ErrorContainer(L('entry error'))
     try:
         update_subscriptions(remove_entries=(entry,))
+    except Unauthorized:
+        raise
     except:
         return podcast(
-            entry=entry,
+            key=key,
             container=AlertContainer(L('subscriptions'),
                                      L('subscriptions update error')),
         )
     return podcast(
-        entry=entry,
+        key=key,
         container=AlertContainer(L('subscriptions'),
                                  LF('unsubscribed', entry['title'])),
     )
 
 
-@app_route('/podcast', entry=dict)
-def podcast(entry, container=None):
+@app_route('/podcast')
+def podcast(key, container=None):
     """
     """
-    if not session.client:
+    from session import Unauthorized
+
+    if not get_session().client:
         # if the user is not logged in, just show the episodes
-        return episodes(entry, container)
+        return episodes(key, container=container)
+
+    entry = entry_store.get(key)
+    if entry is None:
+        return ErrorContainer(L('entry error'))
+    prefetcher.opened(entry['url'])
 
     if not container:
         container = ObjectContainer()
@@ -287,26 +620,35 @@ def podcast(entry, container=None):
     container.title2 = entry['title']
     container.no_cache = True
     container.add(DirectoryObject(
-        key=Callback(episodes, entry=entry),
-        thumb=Resource.ContentsOfURLWithFallback(url=entry['logo_url'],
-                                                 fallback=ICON),
+        key=Callback(episodes, key=key),
+        thumb=thumb(entry['logo_url']),
         summary=entry['description'],
         title=LF('episodes', entry['title'])
     ))
 
     # Check to see if podcast is in user's subscriptions and present
     # subscribe/unsubscribe objects accordingly
-    subscriptions = get_subscriptions()
-    if entry['url'] in [s.url for s in subscriptions]:
+    try:
+        subscriptions = get_subscriptions()
+    except Unauthorized as e:
+        # The route doesn't require the client, so the episodes are still
+        # listed.
+        Log.Warn('Unable to get subscriptions: %s', e)
+        get_session().invalidate('client')
+        return container
+    except Exception as e:
+        Log.Warn('Unable to get subscriptions: %s', e)
+        return container
+    if entry['url'] in subscriptions:
         obj = DirectoryObject(
-            key=Callback(unsubscribe_from, entry=entry),
+            key=Callback(unsubscribe_from, key=key),
             title=L('Unsubscribe'),
             summary=L('unsubscribe from summary'),
             thumb=R('icon-remove.png'),
         )
     else:
         obj = DirectoryObject(
-            key=Callback(subscribe_to, entry=entry),
+            key=Callback(subscribe_to, key=key),
             title=L('Subscribe'),
             summary=L('subscribe to summary'),
             thumb=R('icon-add.png'),
@@ -315,17 +657,34 @@ def podcast(entry, container=None):
     return container
 
 
-@app_route('/episodes', entry=dict, allow_sync=True)
-def episodes(entry, container=None):
+@app_route('/episodes/{page}', page=int, page_size=int, allow_sync=True)
+def episodes(key, page=0, page_size=EPISODES_PAGE_SIZE, container=None):
     """
+    List a page of a podcast's episodes. Only as much of the feed as is needed
+    for the page is parsed.
     """
+    entry = entry_store.get(key)
+    if entry is None:
+        return ErrorContainer(L('entry error'))
+    prefetcher.opened(entry['url'])
+
+    start = page * page_size
+    end = start + page_size
     try:
         # TODO: Use Plex's HTTP API
-        response = podcastparser.parse(entry['url'], urlopen(entry['url']))
+        # Parse one episode past the page to find out if there is a next page.
+        feed = feed_cache.fetch(entry['url'], count=end + 1,
+                                max_age=FEED_REFRESH_TIME,
+                                deadline=FEED_DEADLINE)
     except HTTPError:
         return ErrorContainer(L('url error'))
+    except (IOError, HTTPException):
+        # The host couldn't be reached, or broke off sending the feed.
+        return ErrorContainer(L('host error'))
+    except FeedError:
+        return ErrorContainer(L('feed error'))
 
-    if not len(response['episodes']):
+    if not len(feed['episodes'][start:end]):
         return AlertContainer(L('Episodes'), L('no episodes'))
 
     if not container:
@@ -333,33 +692,71 @@ def episodes(entry, container=None):
     else:
         container.replace_parent = True
     container.title2 = entry['title']
+    if time() - feed['fetched'] > FEED_REFRESH_TIME:
+        container.title2 = LF('stale', container.title2)
 
-    for e in response['episodes']:
-        data = {k: e[k] for k in {'enclosures', 'guid'}}
-        data.update(
-            logo_url=entry['logo_url'],
-            summary=e.get('description', e.get('subtitle', L('no summary'))),
-            originally_available_at=Datetime.FromTimestamp(e['published']),
-            title=e.get('title', L('no title')),
-            total_time=e['total_time'] * 1000,
-        )
-        container.add(episode(entry=data))
+    for i, e in enumerate(feed['episodes'][start:end], start):
+        container.add(episode_object(key, e, entry['logo_url'], i))
 
+    if len(feed['episodes']) > end:
+        container.add(DirectoryObject(
+            key=Callback(episodes, key=key, page=page + 1,
+                         page_size=page_size),
+            title=L('next page'),
+        ))
     return container
 
 
-def create_media_objects(entry):
-    enclosures = entry['enclosures']
+def prefetch_podcast(item):
+    """
+    Warm the caches of the first page of a podcast's episodes
+    """
+    feed_cache.fetch(item.url, count=EPISODES_PAGE_SIZE + 1,
+                     max_age=FEED_REFRESH_TIME)
+    if item.logo_url:
+        artwork_cache.get(item.logo_url)
+
+
+def thumb(url):
+    """
+    Get the thumb of an object showing the artwork at the given url through
+    the artwork cache
+    """
+    if not url:
+        return R(ICON)
+    return Callback(artwork, url=url)
 
-    # look for audio files in entry description if no enclosures are found
-    summary = entry.get('summary')
-    if not len(enclosures) and summary:
-        matches = AUDIO_URL_REGEX.findall(summary)
-        enclosures = [{'url': m[0], 'mime_type': get_mime_type_from_ext(m[1])}
-                      for m in matches]
 
+@app_route('/artwork')
+def artwork(url):
+    """
+    Serve cached artwork, or the channel icon if the artwork can't be had.
+    Artwork too large to cache is left to the client to download.
+    """
+    image = artwork_cache.get(url)
+    if image is None:
+        return DataObject(Resource.Load(ICON), 'image/png')
+    if image is TOO_LARGE:
+        return Redirect(url)
+    return DataObject(*image)
+
+
+def episode_to_dict(e, logo_url):
+    data = {k: e[k] for k in {'enclosures', 'guid'}}
+    data.update(
+        logo_url=logo_url,
+        summary=e['summary'] or L('no summary'),
+        originally_available_at=Datetime.FromTimestamp(e['published']),
+        title=e.get('title', L('no title')),
+        total_time=e['total_time'] * 1000,
+    )
+    return data
+
+
+def create_media_objects(entry):
     # Throw away duplicate enclosures.
-    enclosures = [dict(t) for t in set([tuple(e.items()) for e in enclosures])]
+    enclosures = [dict(t) for t in
+                  set([tuple(e.items()) for e in entry['enclosures']])]
 
     objects = []
     for e in enclosures:
@@ -376,22 +773,63 @@ def create_media_objects(entry):
     return objects
 
 
-@app_route('/episode', entry=dict)
-def episode(entry, include_container=False):
+def find_episode(url, guid, index=0):
+    """
+    Find the episode whose guid has the given hash in the episode index, or
+    else in the feed, parsing it only up to where the episode was last seen
+    if it is still there.
     """
+    e = episode_index.find(url, lambda g: short_hash(g) == guid)
+    if e is not None:
+        return e
+    for count in (index + 1, 0):
+        feed = feed_cache.fetch(url, count=count)
+        for e in feed['episodes']:
+            if short_hash(e['guid']) == guid:
+                return e
+        if feed['complete']:
+            return None
+
+
+def episode_object(key, e, logo_url, index=0):
     """
-    obj = TrackObject(
-        key=Callback(episode, entry=entry, include_container=True),
+    Create the TrackObject of the `index`th episode of the podcast with the
+    given key
+    """
+    entry = episode_to_dict(e, logo_url)
+    return TrackObject(
+        key=Callback(episode, key=key, guid=short_hash(e['guid']),
+                     index=index, include_container=True),
         rating_key=entry['guid'],
         title=entry.get('title', L('No Title')),
-        summary=podcastparser.remove_html_tags(entry['summary']),
+        summary=entry['summary'],
         duration=entry['total_time'],
         source_title=NAME,
-        thumb=Resource.ContentsOfURLWithFallback(url=entry['logo_url'],
-                                                 fallback=ICON),
+        thumb=thumb(entry['logo_url']),
         items=create_media_objects(entry),
     )
 
+
+@app_route('/episode', index=int)
+def episode(key, guid, index=0, include_container=False):
+    """
+    """
+    entry = entry_store.get(key)
+    if entry is None:
+        return ErrorContainer(L('entry error'))
+    try:
+        e = find_episode(entry['url'], guid, index)
+    except HTTPError:
+        return ErrorContainer(L('url error'))
+    except (IOError, HTTPException):
+        # The host couldn't be reached, or broke off sending the feed.
+        return ErrorContainer(L('host error'))
+    except FeedError:
+        return ErrorContainer(L('feed error'))
+    if e is None:
+        return ErrorContainer(L('entry error'))
+
+    obj = episode_object(key, e, entry['logo_url'], index)
     if include_container:
         return ObjectContainer(objects=[obj])
     else:
@@ -405,59 +843,101 @@ def subscriptions(container=None):
     List all podcasts user is currently subscribed to.
     Allow user to select a podcast and see its episodes or unsubscribe from it.
     """
-    subscriptions = get_subscriptions()
+    from session import Unauthorized
+
+    try:
+        subscriptions = get_subscriptions()
+    except Unauthorized:
+        raise
+    except Exception as e:
+        return client_error(e, L('subscriptions error'))
     if not len(subscriptions):
         return AlertContainer(L('subscriptions'), L('no subscriptions'))
 
     if not container:
         container = ObjectContainer(no_cache=True)
     container.title2 = L('subscriptions')
+    if get_subscriptions.is_offline():
+        container.title2 = LF('stale', container.title2)
 
     for s in subscriptions:
         container.add(DirectoryObject(
-            key=Callback(podcast, entry=podcast_to_dict(s)),
+            key=Callback(podcast, key=entry_store.put(podcast_to_dict(s))),
             title=s.title,
             summary=s.description,
-            thumb=Resource.ContentsOfURLWithFallback(url=s.logo_url,
-                                                     fallback=ICON),
+            thumb=thumb(s.logo_url),
         ))
-
-    # Sort subscriptions on title.
-    container.objects.sort(
-        key=lambda x: TITLE_REGEX.sub('', str(x.title).lower()),
-    )
+    prefetcher.schedule([(s.url, s) for s in subscriptions])
     return container
 
 
+@use_cache('toplist_accessed', TOPLIST_CACHE_TIME, stale=True)
+def get_toplist(use_cache=False):
+    """
+    Get the toplist sliced into pages
+    """
+    key = cache_key('toplist_pages')
+    if use_cache and Data.Exists(key):
+        Log.Info('Using cached toplist')
+        return Data.LoadObject(key)
+
+    pages = paginate(get_session().public_client.get_toplist(TOPLIST_SIZE),
+                     LIST_PAGE_SIZE)
+    Data.SaveObject(key, pages)
+    Dict[cache_key('toplist_accessed')] = time()
+    return pages
+
+
+@use_cache('suggestions_accessed', SUGGESTIONS_CACHE_TIME, stale=True)
+def get_suggestions(use_cache=False):
+    """
+    Get the user's suggestions sliced into pages
+    """
+    key = cache_key('suggestions_pages')
+    if use_cache and Data.Exists(key):
+        Log.Info('Using cached suggestions')
+        return Data.LoadObject(key)
+
+    pages = paginate(get_session().client.get_suggestions(SUGGESTIONS_SIZE),
+                     LIST_PAGE_SIZE)
+    Data.SaveObject(key, pages)
+    Dict[cache_key('suggestions_accessed')] = time()
+    return pages
+
+
 @app_route('/toplist/{page}', page=int)
-@use_cache('toplist_accessed', TOPLIST_CACHE_TIME)
 @public_client_required
-def toplist(page=0, container=None, use_cache=False):
+def toplist(page=0, container=None):
     """
-    List 50 most-popular podcasts and allow user to subscribe to each.
+    List the most-popular podcasts a page at a time and allow user to
+    subscribe to each.
     """
-    if not use_cache or not Data.Exists('toplist'):
-        try:
-            toplist = session.public_client.get_toplist()
-        except Exception:
-            return ErrorContainer(L('toplist error'))
-        Data.SaveObject('toplist', toplist)
-        Dict['toplist_accessed'] = time()
-    else:
-        Log.Info('Using cached toplist')
-        toplist = Data.LoadObject('toplist')
+    try:
+        pages = get_toplist()
+    except Exception as e:
+        return client_error(e, L('toplist error'))
 
     if not container:
         container = ObjectContainer()
     container.title2 = L('toplist')
+    if get_toplist.is_offline():
+        container.title2 = LF('stale', container.title2)
 
-    for item in toplist:
+    items = pages[page] if page < len(pages) else ()
+    for item in items:
         container.add(DirectoryObject(
-            key=Callback(podcast, entry=podcast_to_dict(item)),
+            key=Callback(podcast,
+                         key=entry_store.put(podcast_to_dict(item))),
             title=item.title,
             summary=item.description,
-            thumb=Resource.ContentsOfURLWithFallback(url=item.logo_url,
-                                                     fallback=ICON),
+            thumb=thumb(item.logo_url),
+        ))
+    prefetcher.schedule([(item.url, item) for item in items])
+
+    if page + 1 < len(pages):
+        container.add(DirectoryObject(
+            key=Callback(toplist, page=page + 1),
+            title=L('next page'),
         ))
     return container
 
@@ -466,23 +946,40 @@ def toplist(page=0, container=None, use_cache=False):
 @client_required
 def recommendations(page=0, container=None):
     """
+    List podcasts suggested to the user a page at a time.
     """
-    items = session.client.get_suggestions()
+    from session import Unauthorized
 
-    if not len(items):
+    try:
+        pages = get_suggestions()
+    except Unauthorized:
+        raise
+    except Exception as e:
+        return client_error(e, L('recommendations error'))
+
+    if page >= len(pages):
         return AlertContainer(L('recommendations'), L('no recommendations'))
 
     if not container:
         container = ObjectContainer()
     container.title2 = L('recommendations')
+    if get_suggestions.is_offline():
+        container.title2 = LF('stale', container.title2)
 
-    for item in items:
+    for item in pages[page]:
         container.add(DirectoryObject(
-            key=Callback(podcast, entry=podcast_to_dict(item)),
+            key=Callback(podcast,
+                         key=entry_store.put(podcast_to_dict(item))),
             title=item.title,
             summary=item.description,
-            thumb=Resource.ContentsOfURLWithFallback(url=item.logo_url,
-                                                     fallback=ICON),
+            thumb=thumb(item.logo_url),
+        ))
+    prefetcher.schedule([(item.url, item) for item in pages[page]])
+
+    if page + 1 < len(pages):
+        container.add(DirectoryObject(
+            key=Callback(recommendations, page=page + 1),
+            title=L('next page'),
         ))
     return container
 
@@ -492,34 +989,140 @@ def recommendations(page=0, container=None):
 def subscribe(query=""):
     """
     """
+    from session import Unauthorized
+
+    try:
+        subscriptions = get_subscriptions()
+    except Unauthorized:
+        raise
+    except Exception as e:
+        return client_error(e, L('subscriptions error'))
     # if the user is already subscribed to the feed, alert and return
-    if query in [i.url for i in get_subscriptions()]:
+    if query in subscriptions:
         return AlertContainer(L('subscribe'), LF('already subscribed', query))
     try:
-        item = session.public_client.get_podcast_data(query)
+        item = get_session().public_client.get_podcast_data(query)
     except:
         return ErrorContainer(LF('url error', query))
-    return subscribe_to(entry=podcast_to_dict(item))
+    return subscribe_to(key=entry_store.put(podcast_to_dict(item)))
+
+
+def local_search(query):
+    """
+    Search the user's subscriptions and their indexed episodes, returning
+    the podcast and position of each episode found, or None for podcasts
+    """
+    if not get_session().client:
+        return []
+    subscriptions = get_subscriptions()
+    search_index.sync(subscriptions, episode_index)
+
+    results = []
+    for document in search_index.search(query, LOCAL_SEARCH_SIZE):
+        p = subscriptions.get(document[1])
+        if p is None:
+            continue
+        if document[0] == 'podcast':
+            results.append((p, None, None))
+        else:
+            e = episode_index.get(p.url, document[3])
+            if e is not None:
+                results.append((p, document[2], e))
+    return results
+
+
+def search_key(query):
+    # The directory of each server is searched separately.
+    return (getattr(get_session(), 'server', None), query)
+
+
+def search_podcasts(query):
+    def fetch():
+        search_results = get_session().public_client.search_podcasts(query)
+        search_cache.set(key, search_results)
+        return search_results
+
+    key = search_key(query)
+    search_results = search_cache.get(key)
+    if search_results is None:
+        search_results = flights.do(('search',) + key, fetch)[0]
+    return search_results
 
 
 @app_route('/search/{query}')
 @public_client_required
 def search(query=""):
     """
+    List subscriptions and episodes matching the query ahead of podcasts
+    found in the directory. If the directory takes too long or fails, its
+    expired results of the query are listed, if any.
     """
+    from session import Unauthorized
+
+    query = normalize_query(query)
+    # Local results need the account client; without them the directory is
+    # still searched with the public one.
     try:
-        search_results = session.public_client.search_podcasts(query)
-    except:
+        local_results = local_search(query)
+    except Unauthorized as e:
+        Log.Warn('Unable to search locally: %s', e)
+        get_session().invalidate('client')
+        local_results = []
+    except Exception as e:
+        Log.Warn('Unable to search locally: %s', e)
+        local_results = []
+    found, failed = map_concurrently(transport.context.bind(search_podcasts),
+                                     [query], workers=1,
+                                     budget=SEARCH_TIMEOUT)
+    if found:
+        search_results = found[0]
+    else:
+        search_results = search_cache.get(search_key(query), stale=True)
+    if search_results is None and not local_results:
         return ErrorContainer(L('search error'))
 
     container = ObjectContainer(title2=L('search results'))
-    for item in search_results:
+    if failed and search_results is not None:
+        container.title2 = LF('stale', container.title2)
+    keys = {}
+    for p, i, e in local_results:
+        if p.url not in keys:
+            keys[p.url] = entry_store.put(podcast_to_dict(p))
+        if e is not None:
+            container.add(episode_object(keys[p.url], e, p.logo_url, i))
+            continue
+        container.add(TVShowObject(
+            key=Callback(podcast, key=keys[p.url]),
+            rating_key=p.url,
+            title=p.title,
+            summary=p.description,
+            thumb=thumb(p.logo_url),
+        ))
+    listed = set(p.url for p, _, e in local_results if e is None)
+    for item in search_results or ():
+        if item.url in listed:
+            continue
         container.add(TVShowObject(
-            key=Callback(podcast, entry=podcast_to_dict(item)),
+            key=Callback(podcast,
+                         key=entry_store.put(podcast_to_dict(item))),
             rating_key=item.url,
             title=item.title,
             summary=item.description,
-            thumb=Resource.ContentsOfURLWithFallback(url=item.logo_url,
-                                                     fallback=ICON),
+            thumb=thumb(item.logo_url),
         ))
     return container
+
+
+@app_route('/stats')
+def statistics():
+    """
+    List route times, request times and cache hit ratios.
+    """
+    lines = stats_lines()
+    if not len(lines):
+        return AlertContainer(L('stats'), L('no stats'))
+
+    container = ObjectContainer(title2=L('stats'), no_cache=True)
+    for line in lines:
+        container.add(DirectoryObject(key=Callback(statistics), title=line))
+    return container
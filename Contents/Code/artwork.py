@@ -0,0 +1,238 @@
+from collections import OrderedDict
+from time import time
+from urllib2 import HTTPError, Request
+
+from .plex_framework_api import Data, Hash, Log, Thread
+
+
+# Cached artwork is revalidated with its publisher after this long.
+ARTWORK_REFRESH_TIME = 604800 # one week
+
+# Images larger than this are not cached.
+MAX_IMAGE_SIZE = 2 * 1024 * 1024 # bytes
+
+# Returned by `ArtworkCache.get` for images too large to cache.
+TOO_LARGE = 'too large'
+
+IMAGE_TYPES = {
+    '\x89PNG': 'image/png',
+    '\xff\xd8': 'image/jpeg',
+    'GIF8': 'image/gif',
+}
+
+
+def image_type(data, default='image/jpeg'):
+    for magic, mime_type in IMAGE_TYPES.items():
+        if data.startswith(magic):
+            return mime_type
+    return default
+
+
+class ArtworkCache(object):
+    """
+    A disk cache of podcast artwork keyed by URL
+
+    Images are stored once under a hash of their contents, so podcasts (and
+    all their episodes) sharing a logo share one copy. Each URL keeps the
+    validators of its response and is revalidated with a conditional GET
+    once it is older than `refresh_time`. The least recently used URLs are
+    dropped once the images take more than `max_size` bytes. URLs of images
+    larger than `max_image_size` are kept without an image, so they aren't
+    downloaded again until they are revalidated.
+
+    The index is saved at most every `save_interval` seconds.
+
+    Scaling to the sizes clients ask for is left to the Plex Media Server's
+    photo transcoder, which caches its results.
+    """
+    def __init__(self, transport, prefix='art', max_size=50 * 1024 * 1024,
+                 max_image_size=MAX_IMAGE_SIZE,
+                 refresh_time=ARTWORK_REFRESH_TIME, timeout=15,
+                 save_interval=10):
+        self.transport = transport
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_image_size = max_image_size
+        self.refresh_time = refresh_time
+        self.timeout = timeout
+        self.save_interval = save_interval
+        self.index = None
+        # The size and number of urls of each stored image, and their total.
+        self.images = {}
+        self.size = 0
+        self.dirty = False
+        self.lock = Thread.Lock()
+        self.save_lock = Thread.Lock()
+        # One fetch per URL at a time.
+        self.fetching = {}
+
+    def index_key(self):
+        return '%s_index' % self.prefix
+
+    def image_key(self, digest):
+        return '%s_%s' % (self.prefix, digest)
+
+    def load(self):
+        # URL entries in least recently used order, read from Data on first
+        # use.
+        if self.index is None:
+            self.index = OrderedDict()
+            if Data.Exists(self.index_key()):
+                try:
+                    self.index.update(Data.LoadObject(self.index_key()))
+                except Exception as e:
+                    Log.Warn('Unable to load artwork index: %s', e)
+            for entry in self.index.values():
+                self.add_image(entry)
+
+    def add_image(self, entry):
+        digest = entry['digest']
+        if digest is None:
+            return
+        if digest not in self.images:
+            self.images[digest] = [entry['size'], 0]
+            self.size += entry['size']
+        self.images[digest][1] += 1
+
+    def remove_image(self, entry):
+        """Drop a url's use of its image, returning whether it's unused"""
+        digest = entry['digest']
+        if digest is None:
+            return False
+        image = self.images[digest]
+        image[1] -= 1
+        if image[1]:
+            return False
+        del self.images[digest]
+        self.size -= image[0]
+        return True
+
+    def save(self):
+        # Called with the lock held.
+        if not self.dirty:
+            self.dirty = True
+            Thread.CreateTimer(self.save_interval, self.flush)
+
+    def flush(self):
+        """Save the index if it changed since it was last saved"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                index = list(self.index.items())
+            Data.SaveObject(self.index_key(), index)
+
+    def lookup(self, url):
+        with self.lock:
+            self.load()
+            entry = self.index.pop(url, None)
+            if entry is not None:
+                self.index[url] = entry
+            return entry
+
+    def fetch_lock(self, url):
+        with self.lock:
+            lock = self.fetching.get(url)
+            if lock is None:
+                lock = self.fetching[url] = Thread.Lock()
+            return lock
+
+    def get(self, url):
+        """
+        Get the image data and mime type of the given url, None if it can't
+        be had, or TOO_LARGE if it is too large to cache
+        """
+        entry = self.lookup(url)
+        if entry is None or time() - entry['fetched'] > self.refresh_time:
+            with self.fetch_lock(url):
+                # Another thread may have fetched it meanwhile.
+                entry = self.lookup(url)
+                if entry is None or \
+                        time() - entry['fetched'] > self.refresh_time:
+                    entry = self.fetch(url, entry)
+            with self.lock:
+                self.fetching.pop(url, None)
+        if entry is None:
+            return None
+        if entry['digest'] is None:
+            return TOO_LARGE
+        try:
+            data = Data.Load(self.image_key(entry['digest']))
+        except Exception as e:
+            Log.Warn('Unable to load artwork %s: %s', url, e)
+            self.discard(url)
+            return None
+        return data, entry['mime_type']
+
+    def fetch(self, url, cached=None):
+        request = Request(url)
+        if cached is not None:
+            if cached['etag']:
+                request.add_header('If-None-Match', cached['etag'])
+            if cached['modified']:
+                request.add_header('If-Modified-Since', cached['modified'])
+        try:
+            response = self.transport.open(request, timeout=self.timeout)
+            data = response.read(self.max_image_size + 1)
+            response.close()
+        except HTTPError as e:
+            if e.code == 304 and cached is not None:
+                cached['fetched'] = time()
+                self.store(url, cached)
+                return cached
+            Log.Info('Unable to fetch artwork %s: %s', url, e)
+            return cached
+        except Exception as e:
+            Log.Info('Unable to fetch artwork %s: %s', url, e)
+            return cached
+        headers = response.info()
+        entry = {
+            'etag': headers.getheader('ETag'),
+            'modified': headers.getheader('Last-Modified'),
+            'fetched': time(),
+        }
+        if len(data) > self.max_image_size:
+            Log.Info('Not caching artwork %s larger than %d bytes', url,
+                     self.max_image_size)
+            entry.update(digest=None, size=0, mime_type=None)
+        else:
+            digest = Hash.SHA1(data)
+            if not Data.Exists(self.image_key(digest)):
+                Data.Save(self.image_key(digest), data)
+            entry.update(digest=digest, size=len(data),
+                         mime_type=image_type(
+                             data, headers.getheader('Content-Type') or
+                             'image/jpeg'))
+        self.store(url, entry)
+        return entry
+
+    def store(self, url, entry):
+        with self.lock:
+            self.load()
+            old = self.index.pop(url, None)
+            self.index[url] = entry
+            self.add_image(entry)
+            removed = []
+            if old is not None:
+                removed.append(old)
+            # Drop the least recently used urls over the size limit.
+            while len(self.index) > 1 and self.size > self.max_size:
+                removed.append(self.index.popitem(last=False)[1])
+            self.remove_unused(removed)
+            self.save()
+
+    def discard(self, url):
+        with self.lock:
+            self.load()
+            entry = self.index.pop(url, None)
+            if entry is not None:
+                self.remove_unused([entry])
+                self.save()
+
+    def remove_unused(self, entries):
+        # Remove the images no url uses anymore once `entries` are dropped.
+        for entry in entries:
+            if self.remove_image(entry) and \
+                    Data.Exists(self.image_key(entry['digest'])):
+                Data.Remove(self.image_key(entry['digest']))
@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from time import time
+
+from .entries import short_hash
+from .plex_framework_api import Data, Dict, Log, Thread
+
+
+class TTLCache(object):
+    """
+    A bounded least-recently-used cache whose entries expire after a time to
+    live
+
+    Entries are kept in memory and, if `disk_size` is given, the most recent
+    ones are also saved in Data under the cache's name so they survive plugin
+    restarts. Hits and misses are counted.
+    """
+    def __init__(self, name, size=100, ttl=3600, disk_size=0):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.disk_size = disk_size
+        self.entries = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = Thread.Lock()
+
+    def load(self):
+        # Entries are read from Data on first use.
+        if self.entries is None:
+            self.entries = OrderedDict()
+            if self.disk_size and Data.Exists(self.name):
+                try:
+                    self.entries.update(Data.LoadObject(self.name))
+                except Exception as e:
+                    Log.Warn('Unable to load %s cache: %s', self.name, e)
+
+    def save(self):
+        if self.disk_size:
+            items = list(self.entries.items())[-self.disk_size:]
+            Data.SaveObject(self.name, items)
+
+    def get(self, key, default=None, stale=False):
+        """
+        Get the value of a key, or `default` if it is missing or expired.
+        With `stale`, expired values are returned as well.
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            # Expired entries are kept until they're evicted, for stale use.
+            self.entries[key] = entry
+            if entry[0] < time() and not stale:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()
+            self.entries.pop(key, None)
+            self.entries[key] = (time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            if Data.Exists(self.name):
+                Data.Remove(self.name)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'size': len(self.entries or ()),
+        }
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key into one
+
+    Calls made while a call for the same key is in flight wait for it and
+    share its result, or its exception. Calls that led and calls that
+    shared a result are counted.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.led = 0
+        self.shared = 0
+        self.lock = Thread.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call `func` unless a call for `key` is in flight. Returns the result
+        and whether it was shared with another call.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'done': Thread.Event()}
+                self.led += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = func(*args, **kwargs)
+            return call['result'], False
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+    def stats(self):
+        calls = self.led + self.shared
+        return {
+            'hits': self.shared,
+            'misses': self.led,
+            'hit_ratio': float(self.shared) / calls if calls else 0.0,
+        }
+
+
+class Namespaces(object):
+    """
+    Namespaces keeping the caches of accounts apart
+
+    An account is a server and a username, and its namespace a short hash of
+    them. The namespaces of the `size` most recently used accounts are kept
+    in Dict under the given name; the caches of the others are to be removed.
+    """
+    def __init__(self, name='namespaces', size=5):
+        self.name = name
+        self.size = size
+        self.order = None
+        self.lock = Thread.Lock()
+
+    def use(self, server, username):
+        """
+        Get the namespace of an account and make it the most recently used.
+        Returns the namespace and the namespaces that were dropped to make
+        room for it, with None for the caches kept before namespaces were.
+        """
+        namespace = short_hash(u'%s\n%s' % (server or '', username or ''))
+        with self.lock:
+            removed = []
+            if self.order is None:
+                if Dict[self.name] is not None:
+                    self.order = list(Dict[self.name])
+                else:
+                    self.order = []
+                    removed.append(None)
+            if not removed and self.order and self.order[-1] == namespace:
+                return namespace, removed
+            if namespace in self.order:
+                self.order.remove(namespace)
+            self.order.append(namespace)
+            while len(self.order) > self.size:
+                removed.append(self.order.pop(0))
+            Dict[self.name] = list(self.order)
+            return namespace, removed
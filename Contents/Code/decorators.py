@@ -1,35 +1,120 @@
 import functools
+import random
 from time import time
 
 import app
-from .plex_framework_api import Dict, PrefsObject, route
+from .plex_framework_api import Dict, Log, PrefsObject, Thread, route
 from .shortcuts import L
 from .exceptions import InvalidPrefsError
-from .containers import AlertContainer
+from .containers import AlertContainer, ErrorContainer
 
 
 def app_route(path, method='GET', **kwargs):
     """
-    Routes a function as a subpath of the app
+    Routes a function as a subpath of the app and times its calls
     """
-    return route(app.PREFIX + path, method, **kwargs)
+    def decorator(func):
+        return route(app.PREFIX + path, method, **kwargs)(timed(func, path))
+    return decorator
 
 
-def use_cache(attr, cache_time=0):
+def use_cache(attr, cache_time=0, stale=False, retry_time=60,
+              max_retry_time=3600):
     """
     Run the function with `use_cache` param if the difference of now and the
-    given time attribute is less than the given cache time.
+    given time attribute of the current account is less than the given cache
+    time.
+
+    With `stale`, an expired cache is used anyway while the function is run
+    without it on a background thread to refresh the cache, and the cache is
+    also used if running the function without it fails. Failed refreshes are
+    retried after a jittered backoff doubling from `retry_time` seconds.
+
+    The decorated function gets an `expires_in` function returning the seconds
+    left until the cache expires, an `is_offline` function telling whether
+    the last run without the cache failed (so the cache is used as an
+    offline copy), and a `refresh` function starting a background refresh
+    unless one is already running or a failed one is backing off.
+
+    Concurrent runs without the cache, including background refreshes, are
+    coalesced into one.
     """
     def decorator(func):
+        lock = Thread.Lock()
+        # Failures are counted per account.
+        backoffs = {}
+
+        def backoff():
+            return backoffs.setdefault(app.cache_key(attr),
+                                       {'failures': 0, 'retry_at': 0})
+
+        def expires_in():
+            return (Dict[app.cache_key(attr)] or 0) + cache_time - time()
+
+        def is_offline():
+            return backoff()['failures'] > 0
+
+        def succeeded():
+            backoff()['failures'] = 0
+
+        def failed():
+            state = backoff()
+            state['failures'] += 1
+            delay = min(max_retry_time,
+                        retry_time * 2 ** (state['failures'] - 1))
+            delay *= random.uniform(0.5, 1.0)
+            state['retry_at'] = time() + delay
+            return delay
+
+        def fetch(*args, **kwargs):
+            return app.flights.do(app.cache_key(attr), func, *args,
+                                  use_cache=False, **kwargs)[0]
+
+        def refresh(*args, **kwargs):
+            if time() < backoff()['retry_at'] or not lock.acquire(False):
+                return False
+
+            def run():
+                try:
+                    fetch(*args, **kwargs)
+                    succeeded()
+                except Exception as e:
+                    delay = failed()
+                    Log.Warn('Unable to refresh %s, retrying in %ds: %s',
+                             attr, delay, e)
+                finally:
+                    lock.release()
+            Thread.Create(run)
+            return True
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             use_cache = kwargs.pop('use_cache', None)
             if use_cache is None:
-                now = time()
-                since = Dict[attr] or 0
-                diff = now - since
-                use_cache = diff < cache_time
-            return func(*args, use_cache=use_cache, **kwargs)
+                use_cache = expires_in() > 0
+                if not use_cache and stale and Dict[app.cache_key(attr)]:
+                    if refresh(*args, **kwargs):
+                        Log.Info('Refreshing expired %s', attr)
+                    use_cache = True
+                app.stats.record_cache(attr, use_cache)
+            if not use_cache:
+                try:
+                    result = fetch(*args, **kwargs)
+                except Exception as e:
+                    from session import Unauthorized
+
+                    if isinstance(e, Unauthorized) or not stale or \
+                            not Dict[app.cache_key(attr)]:
+                        raise
+                    failed()
+                    Log.Warn('Using stale %s: %s', attr, e)
+                else:
+                    succeeded()
+                    return result
+            return func(*args, use_cache=True, **kwargs)
+        wrapper.expires_in = expires_in
+        wrapper.is_offline = is_offline
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
@@ -49,15 +134,22 @@ class client_required(object):
         functools.update_wrapper(self, func, assigned=self.wrapper_assignments)
 
     def __call__(self, *args, **kwargs):
-        if not getattr(app.session, self.client_attr):
+        from session import Unauthorized
+
+        session = app.get_session()
+        if getattr(session, self.client_attr):
             try:
-                raise InvalidPrefsError(self.error_message)
-            except InvalidPrefsError as e:
-                return AlertContainer(L('Error'), e.message, objects=[
-                    PrefsObject(title=L('preferences')),
-                ])
-        else:
-            return self.func(*args, **kwargs)
+                return self.func(*args, **kwargs)
+            except Unauthorized:
+                # Clients are used before they are validated, so invalid
+                # preferences show up as a failed call.
+                session.invalidate(self.client_attr)
+        try:
+            raise InvalidPrefsError(self.error_message)
+        except InvalidPrefsError as e:
+            return AlertContainer(L('Error'), e.message, objects=[
+                PrefsObject(title=L('preferences')),
+            ])
 
 
 class public_client_required(client_required):
@@ -66,3 +158,35 @@ class public_client_required(client_required):
     """
     error_message = L('public client error')
     client_attr = 'public_client'
+
+
+class timed(object):
+    """
+    Records the wall time of each call of a route in the app's stats, and
+    holds prefetching back meanwhile. Requests made meanwhile are counted
+    against the route.
+    """
+    wrapper_assignments = client_required.wrapper_assignments
+
+    def __init__(self, func, name):
+        self.func = func
+        self.name = name
+        # The route's own attributes would replace `func`, skip them.
+        functools.update_wrapper(self, func, assigned=self.wrapper_assignments,
+                                 updated=())
+
+    def __call__(self, *args, **kwargs):
+        start = time()
+        result = None
+        context = app.transport.context
+        route, context.route = context.route, self.name
+        app.prefetcher.begin()
+        try:
+            result = self.func(*args, **kwargs)
+            return result
+        finally:
+            app.prefetcher.end()
+            context.route = route
+            app.stats.record_route(self.name, time() - start,
+                                   result is None or
+                                   isinstance(result, ErrorContainer))
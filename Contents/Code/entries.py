@@ -0,0 +1,135 @@
+import json
+from collections import OrderedDict
+
+from .plex_framework_api import Data, Hash, Log, Thread
+
+
+# Length of the hex digest prefix used as a key.
+KEY_LENGTH = 16
+
+# Podcast fields that change without the podcast changing, and are left out of
+# its key.
+VOLATILE_FIELDS = ('subscribers', 'subscribers_last_week')
+
+
+def short_hash(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return Hash.SHA1(s)[:KEY_LENGTH]
+
+
+class EntryStore(object):
+    """
+    Podcast entries saved once under a short hash of their contents
+
+    Callbacks carry only the key of an entry instead of the entry itself,
+    which keeps container payloads small. Entries are kept in memory and
+    saved in Data so keys of earlier containers still resolve after a
+    restart. Only the `disk_size` most recently used entries are kept in
+    Data; the order of use is saved along with them at most every
+    `save_interval` seconds after an entry is added or removed.
+    """
+    def __init__(self, prefix='entry', memory_size=1000, disk_size=5000,
+                 save_interval=10):
+        self.prefix = prefix
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.save_interval = save_interval
+        self.entries = OrderedDict()
+        self.index = None
+        self.dirty = False
+        self.lock = Thread.Lock()
+        self.save_lock = Thread.Lock()
+
+    def data_key(self, key):
+        return '%s_%s' % (self.prefix, key)
+
+    def index_key(self):
+        return '%s_index' % self.prefix
+
+    def load(self):
+        # Keys of the entries in Data in least recently used order, read from
+        # Data on first use.
+        if self.index is None:
+            self.index = OrderedDict()
+            if Data.Exists(self.index_key()):
+                try:
+                    self.index.update(
+                        (key, None) for key in
+                        Data.LoadObject(self.index_key()))
+                except Exception as e:
+                    Log.Warn('Unable to load entry index: %s', e)
+
+    def use(self, key):
+        """
+        Mark an entry in Data as used, returning whether it was known and the
+        keys of the entries evicted to make room for it
+        """
+        self.load()
+        known = key in self.index
+        self.index.pop(key, None)
+        self.index[key] = None
+        removed = []
+        while len(self.index) > self.disk_size:
+            removed.append(self.index.popitem(last=False)[0])
+        if not known or removed:
+            self.save()
+        return known, removed
+
+    def save(self):
+        # Called with the lock held.
+        if not self.dirty:
+            self.dirty = True
+            Thread.CreateTimer(self.save_interval, self.flush)
+
+    def flush(self):
+        """Save the index if it changed since it was last saved"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                index = list(self.index)
+            Data.SaveObject(self.index_key(), index)
+
+    def remove(self, keys):
+        for key in keys:
+            if Data.Exists(self.data_key(key)):
+                Data.Remove(self.data_key(key))
+
+    def key(self, entry):
+        content = {k: v for k, v in entry.items() if k not in VOLATILE_FIELDS}
+        return short_hash(json.dumps(content, sort_keys=True))
+
+    def put(self, entry):
+        """Store an entry and return its key"""
+        key = self.key(entry)
+        with self.lock:
+            stored = self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.memory_size:
+                self.entries.popitem(last=False)
+            known, removed = self.use(key)
+        self.remove(removed)
+        if not known:
+            if not Data.Exists(self.data_key(key)):
+                Data.SaveObject(self.data_key(key), entry)
+        elif stored is not None and stored != entry:
+            Data.SaveObject(self.data_key(key), entry)
+        return key
+
+    def get(self, key):
+        """Get the entry of the given key or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.use(key)
+        if entry is None and Data.Exists(self.data_key(key)):
+            entry = Data.LoadObject(self.data_key(key))
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.memory_size:
+                    self.entries.popitem(last=False)
+                removed = self.use(key)[1]
+            self.remove(removed)
+        return entry
@@ -11,3 +11,11 @@ class ChannelError(Exception):
 
 class InvalidPrefsError(ChannelError):
     logger = Log.Warn
+
+
+class FeedError(ChannelError):
+    logger = Log.Warn
+
+
+class FeedTimeoutError(FeedError):
+    pass
@@ -0,0 +1,480 @@
+import re
+import zlib
+from httplib import HTTPException
+from collections import OrderedDict
+from time import time
+from urllib2 import HTTPError, Request
+from xml import sax
+
+from .cache import SingleFlight
+from .exceptions import FeedError, FeedTimeoutError
+from .plex_framework_api import Data, Hash, Log, Thread
+from .utils import get_mime_type_from_ext
+
+
+# Only the episode fields used to render listings are kept in the cache.
+EPISODE_FIELDS = ('guid', 'title', 'published', 'total_time', 'enclosures')
+
+# Number of bytes fed to the parser at a time.
+CHUNK_SIZE = 16384
+
+# Feeds are given up on past these limits.
+MAX_FEED_SIZE = 20 * 1024 * 1024 # decompressed bytes
+MAX_FEED_TIME = 60 # seconds per parse
+
+
+AUDIO_URL_REGEX = re.compile(
+    r"""(https?:\/\/                             # scheme
+        (?:[^/\s]+)                              # domain name
+        \/(?:[^\s]*\/)?                          # path
+        (?:[^\s\/]*(?<=[^\/])\.                  # filename
+        (?P<ext>m4[abpvr]|mp[34]|3gp|aac|ogg)))  # extension""",
+    re.VERBOSE,
+)
+
+
+def trim_episode(episode):
+    """
+    Keep the fields of an episode used to render listings, with its
+    description stripped of markup as its summary
+    """
+    from podcastparser import remove_html_tags
+
+    trimmed = {k: episode[k] for k in EPISODE_FIELDS if k in episode}
+    description = episode.get('description', episode.get('subtitle', ''))
+    # Look for audio files in the description if no enclosures are found.
+    if not trimmed.get('enclosures') and description:
+        trimmed['enclosures'] = [
+            {'url': m[0], 'mime_type': get_mime_type_from_ext(m[1])}
+            for m in AUDIO_URL_REGEX.findall(description)
+        ]
+    trimmed['summary'] = remove_html_tags(description)
+    return trimmed
+
+
+def has_episodes(feed, count=0):
+    """
+    Check that a feed has at least `count` episodes parsed, or all of them if
+    `count` is 0
+    """
+    return feed['complete'] or (count and len(feed['episodes']) >= count)
+
+
+# The handler class is created on first use so podcastparser isn't imported
+# at startup.
+handler_classes = {}
+
+
+def feed_handler_class():
+    """
+    Get a podcastparser handler class that keeps count of its fully parsed
+    episodes, and keeps them in document order as podcastparser sorts its
+    own list once the feed ends
+    """
+    if 'feed' not in handler_classes:
+        import podcastparser
+
+        class FeedHandler(podcastparser.PodcastHandler):
+            def __init__(self, url):
+                podcastparser.PodcastHandler.__init__(self, url, 0)
+                self.parsed = 0
+                self.document = []
+                self.newest_first = True
+
+            def validate_episode(self):
+                podcastparser.PodcastHandler.validate_episode(self)
+                if len(self.episodes) > self.parsed:
+                    episode = self.episodes[-1]
+                    if self.document and episode['published'] > \
+                            self.document[-1]['published']:
+                        self.newest_first = False
+                    self.document.append(episode)
+                self.parsed = len(self.episodes)
+
+        handler_classes['feed'] = FeedHandler
+    return handler_classes['feed']
+
+
+class FeedStream(object):
+    """
+    The body of a feed response, decompressed as it is read
+
+    Reading fails with a FeedError once more than `max_size` decompressed
+    bytes have been read, once `max_time` seconds have passed since `begin`
+    was last called, or if the body doesn't decompress. `wire_bytes` counts
+    the bytes actually downloaded.
+    """
+    def __init__(self, response, max_size=MAX_FEED_SIZE,
+                 max_time=MAX_FEED_TIME):
+        self.response = response
+        self.max_size = max_size
+        self.max_time = max_time
+        self.encoding = (response.info().getheader('Content-Encoding') or
+                         '').lower()
+        if self.encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+        self.wire_bytes = 0
+        self.size = 0
+        self.begin()
+
+    def begin(self):
+        self.deadline = time() + self.max_time
+
+    def decompress(self, chunk):
+        try:
+            return self.inflate(chunk)
+        except zlib.error as e:
+            raise FeedError('Feed is not valid %s data: %s' % (self.encoding,
+                                                               e))
+
+    def inflate(self, chunk):
+        if not chunk:
+            return self.decompressor.flush()
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error:
+            if self.encoding != 'deflate' or self.wire_bytes != len(chunk):
+                raise
+            # Some servers send raw deflate data without a zlib header.
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk)
+
+    def read(self, size):
+        while True:
+            if time() > self.deadline:
+                raise FeedTimeoutError('Feed took longer than %ds to '
+                                       'download' % self.max_time)
+            chunk = self.response.read(size)
+            self.wire_bytes += len(chunk)
+            data = self.decompress(chunk) if self.decompressor else chunk
+            self.size += len(data)
+            if self.size > self.max_size:
+                raise FeedError('Feed is larger than %d bytes' %
+                                self.max_size)
+            # Compressed chunks don't always decompress to anything yet.
+            if data or not chunk:
+                return data
+
+    def close(self):
+        self.response.close()
+
+
+class FeedCursor(object):
+    """
+    A resumable parse of a feed response
+
+    The response is fed to the parser in chunks only until the requested
+    number of episodes has been parsed, so the work done depends on how many
+    episodes are needed rather than on the length of the feed.
+
+    Episodes are listed newest first. A feed whose first episodes aren't
+    newest first is parsed whole and sorted on publication date. Once part
+    of a feed has been listed in document order, the rest of it is listed in
+    document order too, so its pages don't change order.
+    """
+    def __init__(self, url, stream, chunk_size=CHUNK_SIZE):
+        self.handler = feed_handler_class()(url)
+        self.parser = sax.make_parser()
+        self.parser.setContentHandler(self.handler)
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.complete = False
+        self.partial = False
+
+    @property
+    def episodes(self):
+        if self.partial:
+            return list(self.handler.document)
+        return self.handler.episodes[:self.handler.parsed]
+
+    def parsed_enough(self, count):
+        if not count or self.handler.parsed < count:
+            return False
+        return self.partial or self.handler.newest_first
+
+    def parse(self, count=0):
+        """
+        Parse until at least `count` episodes are available or the feed ends.
+        A count of 0 parses the whole feed.
+        """
+        self.stream.begin()
+        while not self.complete and not self.parsed_enough(count):
+            chunk = self.stream.read(self.chunk_size)
+            try:
+                if chunk:
+                    self.parser.feed(chunk)
+                else:
+                    self.close()
+                    self.parser.close()
+                    self.complete = True
+            except sax.SAXException as e:
+                raise FeedError('Feed is malformed: %s' % e)
+        if not self.complete:
+            self.partial = True
+
+    def close(self):
+        self.stream.close()
+
+
+class FeedCache(object):
+    """
+    A persistent cache of parsed feeds keyed by feed URL
+
+    Each cached feed keeps the validators (ETag and Last-Modified) of the
+    response it was parsed from so it can be revalidated with a conditional
+    GET. A feed that has not been modified is never downloaded or parsed
+    again.
+
+    Feeds are parsed only as far as the episodes requested. Unfinished parses
+    are kept open so that later requests continue where the previous one
+    stopped.
+
+    Feeds are requested compressed and are limited in size and download time.
+
+    The episodes of cached feeds are kept in the given episode index, the
+    cache only keeps the state of each feed.
+
+    Concurrent fetches of a feed are coalesced into one.
+
+    If given, `observer` is called with the url, the seconds a request or
+    parse of the feed took until the episodes were read and whether it
+    failed.
+    """
+    def __init__(self, transport, index, prefix='feed', memory_size=20,
+                 cursors_size=5, max_size=MAX_FEED_SIZE,
+                 max_time=MAX_FEED_TIME, observer=None):
+        self.transport = transport
+        self.observer = observer
+        self.index = index
+        self.max_size = max_size
+        self.max_time = max_time
+        self.wire_bytes = 0
+        self.prefix = prefix
+        self.memory_size = memory_size
+        self.cursors_size = cursors_size
+        self.feeds = OrderedDict()
+        self.cursors = OrderedDict()
+        self.flights = SingleFlight()
+        # Feeds are fetched from several threads at once.
+        self.lock = Thread.Lock()
+
+    def key(self, url):
+        return '%s_%s' % (self.prefix, Hash.MD5(url))
+
+    def get(self, url):
+        """Get the cached feed of the given url or None"""
+        with self.lock:
+            feed = self.feeds.pop(url, None)
+        if feed is None:
+            key = self.key(url)
+            if not Data.Exists(key):
+                return None
+            feed = Data.LoadObject(key)
+            if 'episodes' in feed:
+                # Feeds cached before the index was kept are fetched again.
+                return None
+            feed['episodes'] = self.index.episodes(url)
+        self.remember(url, feed)
+        return feed
+
+    def set(self, url, feed):
+        self.remember(url, feed)
+        self.index.update(url, feed['episodes'], feed['complete'])
+        Data.SaveObject(self.key(url), {k: v for k, v in feed.items()
+                                        if k != 'episodes'})
+
+    def remember(self, url, feed):
+        # Keep the most-recently used feeds in memory.
+        with self.lock:
+            self.feeds.pop(url, None)
+            self.feeds[url] = feed
+            while len(self.feeds) > self.memory_size:
+                self.feeds.popitem(last=False)
+
+    def observe(self, url, start, error):
+        if self.observer is not None:
+            try:
+                self.observer(url, time() - start, error)
+            except Exception:
+                pass
+
+    def open(self, url, cached=None):
+        """
+        Request the feed of the given url, conditionally if a cached copy is
+        given. Returns None if the cached copy has not been modified.
+        """
+        start = time()
+        request = Request(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        if cached is not None:
+            if cached['etag']:
+                request.add_header('If-None-Match', cached['etag'])
+            if cached['modified']:
+                request.add_header('If-Modified-Since', cached['modified'])
+        try:
+            # The breaker is told of the outcome once the feed is read, see
+            # `parse`.
+            response = self.transport.open(request, defer=True)
+        except HTTPError as e:
+            if e.code == 304 and cached is not None:
+                self.observe(url, start, False)
+                return None
+            self.observe(url, start, True)
+            raise
+        except Exception:
+            self.observe(url, start, True)
+            raise
+        return response
+
+    def open_cursor(self, url, response):
+        stream = FeedStream(response, self.max_size, self.max_time)
+        cursor = FeedCursor(url, stream)
+        self.close_cursor(url)
+        with self.lock:
+            self.cursors[url] = cursor
+            while len(self.cursors) > self.cursors_size:
+                self.cursors.popitem(last=False)[1].close()
+        return cursor
+
+    def get_cursor(self, url):
+        with self.lock:
+            return self.cursors.get(url)
+
+    def close_cursor(self, url):
+        with self.lock:
+            cursor = self.cursors.pop(url, None)
+        if cursor is not None:
+            cursor.close()
+
+    def fetch(self, url, count=0, max_age=0, deadline=None):
+        """
+        Get the feed of the given url with at least `count` of its episodes
+        parsed (all of them if `count` is 0), downloading and parsing it only
+        if it has changed since it was cached. A cached feed fetched less than
+        `max_age` seconds ago isn't revalidated.
+
+        With a `deadline`, a cached feed with enough episodes is returned as
+        it is if fetching fails or takes longer than `deadline` seconds. The
+        fetch then goes on in the background.
+        """
+        if deadline is not None:
+            cached = self.get(url)
+            if cached is not None and has_episodes(cached, count) and \
+                    time() - cached['fetched'] >= max_age:
+                return self.fetch_within(url, cached, count, max_age,
+                                         deadline)
+        feed, shared = self.flights.do(url, self.fetch_once, url, count,
+                                       max_age)
+        if shared and not has_episodes(feed, count):
+            # The fetch waited on didn't parse as far as this one needs.
+            return self.fetch(url, count, max_age)
+        return feed
+
+    def fetch_within(self, url, cached, count, max_age, deadline):
+        result = {}
+        done = Thread.Event()
+
+        def run():
+            try:
+                result['feed'] = self.fetch(url, count, max_age)
+            except Exception as e:
+                Log.Info('Using stale feed %s: %s', url, e)
+            finally:
+                done.set()
+
+        Thread.Create(self.transport.context.bind(run))
+        if not done.wait(deadline):
+            Log.Info('Using stale feed %s past the deadline', url)
+        return result.get('feed', cached)
+
+    def fetch_once(self, url, count=0, max_age=0):
+        cached = self.get(url)
+        if cached is not None and time() - cached['fetched'] < max_age:
+            if has_episodes(cached, count):
+                return cached
+            # A fresh feed needs no request if its parse can go on.
+            feed = self.resume(url, cached, count)
+            if feed is not None:
+                return feed
+        start = time()
+        response = self.open(url, cached)
+
+        if response is None:
+            Log.Info('Using cached feed %s', url)
+            feed = cached
+            feed['fetched'] = time()
+            self.index.touch(url)
+            if has_episodes(feed, count):
+                return feed
+            resumed = self.resume(url, feed, count)
+            if resumed is not None:
+                return resumed
+            # The previous parse can't be resumed, so start from the top.
+            start = time()
+            response = self.open(url)
+
+        headers = response.info()
+        feed = {
+            'etag': headers.getheader('ETag'),
+            'modified': headers.getheader('Last-Modified'),
+            'fetched': time(),
+            'complete': False,
+            'episodes': [],
+        }
+        return self.parse(url, feed, self.open_cursor(url, response), count,
+                          start)
+
+    def resume(self, url, feed, count=0):
+        """
+        Go on with the open parse of the feed of the given url, if any.
+        Returns None if there is none or it fails to read.
+        """
+        cursor = self.get_cursor(url)
+        if cursor is None:
+            return None
+        try:
+            return self.parse(url, feed, cursor, count)
+        except IOError:
+            Log.Info('Restarting parse of feed %s', url)
+            return None
+
+    def parse(self, url, feed, cursor, count=0, start=None):
+        """
+        Parse the feed of the given url from its cursor, timed from `start`
+        if the parse follows the request of the feed
+        """
+        if start is None:
+            start = time()
+        wire_bytes = cursor.stream.wire_bytes
+        try:
+            cursor.parse(count)
+        except Exception as e:
+            self.close_cursor(url)
+            # Hosts that stall or break off are failing; feeds that don't
+            # parse are not.
+            self.transport.report(url, isinstance(
+                e, (IOError, HTTPException, FeedTimeoutError)))
+            self.observe(url, start, True)
+            raise
+        finally:
+            downloaded = cursor.stream.wire_bytes - wire_bytes
+            with self.lock:
+                self.wire_bytes += downloaded
+        self.transport.report(url, False)
+        self.observe(url, start, False)
+        Log.Debug('Downloaded %d bytes of feed %s (%d bytes decompressed)',
+                  downloaded, url, cursor.stream.size)
+        episodes = cursor.episodes
+        if cursor.complete:
+            with self.lock:
+                self.cursors.pop(url, None)
+            feed['episodes'] = [trim_episode(e) for e in episodes]
+        else:
+            start = len(feed['episodes'])
+            feed['episodes'].extend(trim_episode(e) for e in episodes[start:])
+        feed['complete'] = cursor.complete
+        self.set(url, feed)
+        return feed
@@ -0,0 +1,189 @@
+import heapq
+from collections import OrderedDict
+from time import time
+
+from .plex_framework_api import Data, Hash, Log, Thread
+
+
+class EpisodeIndex(object):
+    """
+    A persistent index of the episodes of all parsed feeds
+
+    Each feed has a bucket in Data holding its episodes keyed by guid and
+    the guids in feed order. Updates are upserts on guid: episodes of a
+    partly parsed feed that were not parsed again are kept, so they can
+    still be found by guid, until a complete parse drops the ones no longer
+    in the feed.
+
+    The newest `head_size` episodes of each feed are also kept together in
+    a single Data object, ordered on publication date, along with the times
+    each feed was last indexed and last changed. Listing the most recent
+    episodes across feeds only reads that object, and only the `max_feeds`
+    most recently indexed feeds are kept in it (see `fit`). As that object
+    is large, changes to it are saved together `save_interval` seconds after
+    the first of them. Heads lost before they were saved are put back from
+    the buckets when their feeds are next fetched.
+    """
+    def __init__(self, prefix='episodes', head_size=50, max_feeds=200,
+                 memory_size=20, save_interval=10):
+        self.prefix = prefix
+        self.head_size = head_size
+        self.max_feeds = max_feeds
+        self.memory_size = memory_size
+        self.save_interval = save_interval
+        self.buckets = OrderedDict()
+        self.heads = None
+        self.dirty = False
+        self.lock = Thread.Lock()
+        self.save_lock = Thread.Lock()
+
+    def bucket_key(self, url):
+        return '%s_%s' % (self.prefix, Hash.MD5(url))
+
+    def heads_key(self):
+        return '%s_published' % self.prefix
+
+    def load_heads(self):
+        # Feed heads in least recently updated order, read from Data on first
+        # use.
+        if self.heads is None:
+            self.heads = OrderedDict()
+            if Data.Exists(self.heads_key()):
+                try:
+                    self.heads.update(Data.LoadObject(self.heads_key()))
+                except Exception as e:
+                    Log.Warn('Unable to load episode index: %s', e)
+
+    def bucket(self, url):
+        bucket = self.buckets.pop(url, None)
+        if bucket is None:
+            key = self.bucket_key(url)
+            bucket = {'order': [], 'episodes': {}}
+            if Data.Exists(key):
+                try:
+                    bucket = Data.LoadObject(key)
+                except Exception as e:
+                    Log.Warn('Unable to load episodes of %s: %s', url, e)
+        # Keep the most-recently used buckets in memory.
+        self.buckets[url] = bucket
+        while len(self.buckets) > self.memory_size:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def update(self, url, episodes, complete=False):
+        """
+        Upsert the given episodes of a feed, in feed order. With `complete`,
+        episodes of the feed that aren't given are removed.
+        """
+        with self.lock:
+            bucket = self.bucket(url)
+            if complete:
+                bucket['episodes'] = {}
+            for e in episodes:
+                bucket['episodes'][e['guid']] = e
+            bucket['order'] = [e['guid'] for e in episodes]
+            Data.SaveObject(self.bucket_key(url), bucket)
+            self.set_head(url, episodes)
+            self.save_heads()
+
+    def set_head(self, url, episodes):
+        self.load_heads()
+        self.heads.pop(url, None)
+        self.heads[url] = {
+            'indexed': time(),
+            'updated': time(),
+            'episodes': heapq.nlargest(
+                self.head_size, enumerate(episodes),
+                key=lambda x: x[1]['published'],
+            ),
+        }
+        while len(self.heads) > self.max_feeds:
+            self.heads.popitem(last=False)
+
+    def touch(self, url):
+        """Mark a feed as indexed now, as it hasn't changed"""
+        with self.lock:
+            self.load_heads()
+            head = self.heads.pop(url, None)
+            if head is not None:
+                head['indexed'] = time()
+                self.heads[url] = head
+            else:
+                # The head was evicted; put it back from the bucket.
+                bucket = self.bucket(url)
+                if not bucket['order']:
+                    return
+                self.set_head(url, [bucket['episodes'][guid]
+                                    for guid in bucket['order']])
+            self.save_heads()
+
+    def fit(self, count):
+        """Keep the heads of at least `count` feeds"""
+        with self.lock:
+            self.max_feeds = max(self.max_feeds, count)
+
+    def save_heads(self):
+        # Called with the lock held.
+        if not self.dirty:
+            self.dirty = True
+            Thread.CreateTimer(self.save_interval, self.flush)
+
+    def flush(self):
+        """Save the heads if they changed since they were last saved"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                heads = list(self.heads.items())
+            Data.SaveObject(self.heads_key(), heads)
+
+    def indexed(self, url):
+        """Get the time the feed of the given url was last indexed, or 0"""
+        with self.lock:
+            self.load_heads()
+            head = self.heads.get(url)
+            return head['indexed'] if head is not None else 0
+
+    def updated(self, url):
+        """Get the time the episodes of a feed last changed, or 0"""
+        with self.lock:
+            self.load_heads()
+            head = self.heads.get(url)
+            return head.get('updated', 0) if head is not None else 0
+
+    def get(self, url, guid):
+        """Get the episode of a feed with the given guid, or None"""
+        with self.lock:
+            return self.bucket(url)['episodes'].get(guid)
+
+    def episodes(self, url):
+        """Get the episodes of a feed in feed order"""
+        with self.lock:
+            bucket = self.bucket(url)
+            return [bucket['episodes'][guid] for guid in bucket['order']]
+
+    def find(self, url, match):
+        """Get the first episode of a feed whose guid matches, or None"""
+        with self.lock:
+            bucket = self.bucket(url)
+            for guid, e in bucket['episodes'].items():
+                if match(guid):
+                    return e
+        return None
+
+    def recent(self, urls, count):
+        """
+        Get the `count` most recently published episodes of the given feeds,
+        newest first, as tuples of the feed url, the position of the episode
+        in its feed and the episode
+        """
+        with self.lock:
+            self.load_heads()
+            heads = [(url, self.heads[url]['episodes']) for url in urls
+                     if url in self.heads]
+        return heapq.nlargest(
+            count,
+            ((url, i, e) for url, head in heads for i, e in head),
+            key=lambda x: x[2]['published'],
+        )
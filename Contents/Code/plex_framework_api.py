@@ -14,6 +14,7 @@ ClientPlatform
 Container
 ContainerContent
 Data
+DataObject
 Datetime
 Dict
 DirectoryObject
@@ -40,6 +41,7 @@ Protocol
 R
 RSS
 RTMPVideoURL
+Redirect
 Request
 Resource
 Response
@@ -0,0 +1,163 @@
+from collections import OrderedDict, deque
+from time import time
+
+from .plex_framework_api import Log, Thread
+
+
+# Prefetching waits until no route has run for this long.
+IDLE_TIME = 0.5 # seconds
+
+# The number of items prefetched is reconsidered after this many lists.
+ADAPT_WINDOW = 10
+# Fewer items are prefetched if less than this share of them is opened, and
+# more if over the other.
+LOW_HIT_RATIO = 0.1
+HIGH_HIT_RATIO = 0.5
+
+
+class Prefetcher(object):
+    """
+    Warms caches in the background for the first items of a listed page
+
+    Each list shown schedules its first `size` items, replacing whatever of
+    the previous list wasn't prefetched yet. `size` adapts to the items the
+    user opens: it shrinks while few prefetched items are opened, grows while
+    many are, and grows to cover an item further down a list that was opened
+    without being prefetched.
+
+    Items are fetched by `fetch` on `workers` threads, only while no route is
+    running, and only while fewer than `max_bytes` (as counted by `spent`)
+    have been downloaded in the last `window` seconds.
+    """
+    def __init__(self, fetch, spent, workers=2, size=3, max_size=10,
+                 max_bytes=10 * 1024 * 1024, window=600):
+        self.fetch = fetch
+        self.spent = spent
+        self.workers = workers
+        self.size = size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.window = window
+        self.window_start = 0
+        self.window_spent = 0
+        self.pending = []
+        self.listed = {}
+        # Prefetched items not opened yet, with the counts of their list.
+        self.prefetched = OrderedDict()
+        self.lists = deque(maxlen=ADAPT_WINDOW)
+        self.count = 0
+        self.hits = 0
+        self.active = 0
+        self.last_active = 0
+        self.started = False
+        self.ready = Thread.Event()
+        self.lock = Thread.Lock()
+
+    def begin(self):
+        """Hold prefetching back while a route runs"""
+        with self.lock:
+            self.active += 1
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            self.last_active = time()
+
+    def schedule(self, items):
+        """
+        Prefetch the first items of a list of (key, item) tuples, cancelling
+        the prefetches of the previous list
+        """
+        with self.lock:
+            self.adapt()
+            self.listed = dict((key, i) for i, (key, _) in enumerate(items))
+            counts = [0, 0]
+            self.lists.append(counts)
+            self.pending = []
+            for key, item in items[:self.size]:
+                if key not in self.prefetched:
+                    self.pending.append((key, item, counts))
+            if not self.started:
+                self.started = True
+                for _ in range(self.workers):
+                    Thread.Create(self.work)
+            self.ready.set()
+
+    def opened(self, key):
+        """Record that the user opened an item"""
+        with self.lock:
+            counts = self.prefetched.pop(key, None)
+            if counts is not None:
+                counts[1] += 1
+                self.hits += 1
+            elif self.listed.get(key, 0) >= self.size:
+                self.size = min(self.max_size, self.listed[key] + 1)
+                Log.Debug('Prefetching %d items of each list', self.size)
+
+    def adapt(self):
+        if len(self.lists) < ADAPT_WINDOW:
+            return
+        prefetched = sum(c[0] for c in self.lists)
+        if not prefetched:
+            return
+        ratio = float(sum(c[1] for c in self.lists)) / prefetched
+        if ratio < LOW_HIT_RATIO and self.size > 1:
+            self.size -= 1
+        elif ratio > HIGH_HIT_RATIO and self.size < self.max_size:
+            self.size += 1
+        else:
+            return
+        self.lists.clear()
+        Log.Debug('Prefetching %d items of each list', self.size)
+
+    def next(self):
+        while True:
+            with self.lock:
+                if self.pending:
+                    return self.pending.pop(0)
+                self.ready.clear()
+            self.ready.wait()
+
+    def idle(self):
+        with self.lock:
+            return not self.active and time() - self.last_active > IDLE_TIME
+
+    def within_budget(self):
+        spent = self.spent()
+        with self.lock:
+            if time() - self.window_start > self.window:
+                self.window_start = time()
+                self.window_spent = spent
+            return spent - self.window_spent < self.max_bytes
+
+    def work(self):
+        while True:
+            key, item, counts = self.next()
+            while not self.idle():
+                Thread.Sleep(IDLE_TIME)
+            with self.lock:
+                # The list may have been replaced meanwhile.
+                if self.lists and counts is not self.lists[-1]:
+                    continue
+            if not self.within_budget():
+                Log.Debug('Not prefetching %s over the budget', key)
+                continue
+            try:
+                self.fetch(item)
+            except Exception as e:
+                Log.Debug('Unable to prefetch %s: %s', key, e)
+                continue
+            with self.lock:
+                counts[0] += 1
+                self.count += 1
+                self.prefetched.pop(key, None)
+                self.prefetched[key] = counts
+                while len(self.prefetched) > self.max_size * ADAPT_WINDOW:
+                    self.prefetched.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.count - self.hits,
+            'hit_ratio': float(self.hits) / self.count if self.count else 0.0,
+        }
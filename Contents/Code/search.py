@@ -0,0 +1,125 @@
+import math
+import re
+from collections import Counter
+
+from .plex_framework_api import Thread
+
+
+TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# Terms in titles count this many times as much as terms in descriptions.
+TITLE_WEIGHT = 3.0
+
+# Term weights saturate at this rate, so a term repeated in a long text
+# doesn't outrank a title match.
+SATURATION = 1.2
+
+
+def terms(text):
+    return TERM_REGEX.findall((text or '').lower())
+
+
+class SearchIndex(object):
+    """
+    An in-memory inverted index of subscribed podcasts and their episodes
+
+    Each term maps to the documents containing it and its weight in each.
+    A query matches the documents containing all of its terms, ranked on the
+    sum of the saturated weights of the terms times their inverse document
+    frequency.
+
+    The index is brought in step with the subscriptions and the episode
+    index before each search: feeds whose episodes changed since they were
+    indexed are indexed again, and feeds no longer subscribed to are
+    removed. Only the first `feed_size` episodes of each feed are indexed.
+    """
+    def __init__(self, feed_size=500):
+        self.feed_size = feed_size
+        self.postings = {}
+        self.documents = {}
+        self.next_id = 0
+        # Documents of each podcast, with the text of the podcast and the
+        # time its episodes were indexed.
+        self.podcasts = {}
+        self.lock = Thread.Lock()
+
+    def add(self, document, title, text=''):
+        weights = Counter()
+        for term in terms(title):
+            weights[term] += TITLE_WEIGHT
+        for term in terms(text):
+            weights[term] += 1
+        doc_id = self.next_id
+        self.next_id += 1
+        for term, weight in weights.items():
+            self.postings.setdefault(term, {})[doc_id] = weight
+        self.documents[doc_id] = (document, list(weights))
+        return doc_id
+
+    def remove(self, doc_id):
+        _, doc_terms = self.documents.pop(doc_id)
+        for term in doc_terms:
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+
+    def remove_podcast(self, url):
+        for doc_id in self.podcasts.pop(url)['documents']:
+            self.remove(doc_id)
+
+    def sync(self, subscriptions, episode_index):
+        """
+        Index the given subscriptions and the episodes of their feeds that
+        changed since they were last indexed
+        """
+        with self.lock:
+            urls = set()
+            for podcast in subscriptions:
+                urls.add(podcast.url)
+                text = (podcast.title, podcast.description)
+                updated = episode_index.updated(podcast.url)
+                indexed = self.podcasts.get(podcast.url)
+                if indexed is not None and indexed['text'] == text and \
+                        indexed['updated'] == updated:
+                    continue
+                if indexed is not None:
+                    self.remove_podcast(podcast.url)
+                documents = [self.add(('podcast', podcast.url), *text)]
+                episodes = episode_index.episodes(podcast.url)
+                for i, e in enumerate(episodes[:self.feed_size]):
+                    documents.append(self.add(
+                        ('episode', podcast.url, i, e['guid']),
+                        e.get('title'), e.get('summary'),
+                    ))
+                self.podcasts[podcast.url] = {'text': text,
+                                              'updated': updated,
+                                              'documents': documents}
+            for url in set(self.podcasts) - urls:
+                self.remove_podcast(url)
+
+    def search(self, query, limit=20):
+        """
+        Get the documents best matching the query, best first. Podcasts are
+        ('podcast', url) and episodes ('episode', url, position, guid).
+        """
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        with self.lock:
+            postings = [self.postings.get(term, {}) for term in query_terms]
+            postings.sort(key=len)
+            if not postings[0]:
+                return []
+            count = float(len(self.documents))
+            scores = {}
+            for doc_id in postings[0]:
+                if all(doc_id in p for p in postings[1:]):
+                    scores[doc_id] = sum(
+                        math.log(1 + count / len(p)) *
+                        p[doc_id] * (SATURATION + 1) /
+                        (p[doc_id] + SATURATION)
+                        for p in postings
+                    )
+            best = sorted(scores, key=lambda d: (-scores[d], d))[:limit]
+            return [self.documents[doc_id][0] for doc_id in best]
@@ -1,4 +1,9 @@
+from time import time
+
+from httppool import Transport
 from mygpoclient.api import MygPodderClient as MygpoClient
+from mygpoclient.http import BadRequest, NotFound, Unauthorized
+from mygpoclient.json import JsonClient
 from mygpoclient.public import PublicClient as MygpoPublicClient
 
 
@@ -16,12 +21,12 @@ class ClientMixin(object):
     """
     docstring for BaseClient
     """
-    def __init__(self, *args, **kwargs):
-        super(ClientMixin, self).__init__(*args, **kwargs)
-        self.validate()
-
     def validate(self):
-        """Attempt a minimal-effort API call to test client viability"""
+        """
+        Attempt a minimal-effort API call to test client viability. Raises a
+        ClientError if the client is invalid, and lets other errors (like the
+        server being unreachable) through.
+        """
         raise NotImplementedError()
 
 
@@ -36,7 +41,7 @@ class Client(ClientMixin, MygpoClient):
     def validate(self):
         try:
             self.get_suggestions(1)
-        except Exception:
+        except Unauthorized:
             raise InvalidClientError()
 
     def pull_subscriptions(self, *args, **kwargs):
@@ -55,15 +60,21 @@ class PublicClient(ClientMixin, MygpoPublicClient):
     def validate(self):
         try:
             self.get_toplist(1)
-        except Exception:
+        except (BadRequest, NotFound, ValueError):
+            # The server is not a gpodder.net webservice.
             raise InvalidPublicClientError()
 
 
 class Session(object):
+    # Connections are pooled for all clients and feeds, and are not persisted
+    # with the session.
+    transport = Transport()
+
     def __init__(self, device_id):
         self.client_is_dirty = True
         self.public_client_is_dirty = True
         self.device_id = device_id
+        self.validations = {}
 
     def __setattr__(self, name, value):
         try:
@@ -73,26 +84,36 @@ class Session(object):
                 super(Session, self).__setattr__(name, value)
         except AttributeError:
             super(Session, self).__setattr__(name, value)
-        if name is 'server':
-            self.client_is_dirty = True
-        if name in ('username', 'password', 'server'):
+        if name == 'server':
             self.public_client_is_dirty = True
-        if name is 'device_name':
-            self.update_device()
+        if name in ('username', 'password', 'server'):
+            self.client_is_dirty = True
+            # Earlier results don't hold for the new settings.
+            self.forget_validation('client')
+            self.forget_validation('public_client')
+        if name == 'device_name':
+            # The server is told in the background, see `update_device`.
+            self.device_updated = True
 
     def create_public_client(self):
-        client = PublicClient(self.server)
+        client = PublicClient(
+            self.server,
+            client_class=self.transport.client_class(JsonClient),
+        )
         # Plex Framework does not allow varible names preceded by an underscore
         self.public_client_ = client
         self.public_client_is_dirty = False
+        self.forget_validation('public_client')
         return self.public_client_
 
     def create_client(self):
         client = Client(self.device_id, self.username, self.password,
-                        self.server)
+                        self.server,
+                        client_class=self.transport.client_class(JsonClient))
         # Plex Framework does not allow varible names preceded by an underscore
         self.client_ = client
         self.client_is_dirty = False
+        self.forget_validation('client')
         return self.client_
 
     def get_or_create_public_client(self):
@@ -109,21 +130,77 @@ class Session(object):
         if self.client_is_dirty:
             client = self.create_client()
             created = True
-            if getattr(self, 'device_updated', False):
-                # Update device if the `device_name` was changed since a client
-                # was created.
-                self.update_device()
         return (client, created)
 
     @property
     def public_client(self):
+        if self.is_invalid('public_client'):
+            return None
         return self.get_or_create_public_client()[0]
 
     @property
     def client(self):
+        if not getattr(self, 'username', None) or self.is_invalid('client'):
+            return None
         return self.get_or_create_client()[0]
 
+    def validation_key(self, name):
+        server = getattr(self, 'server', None)
+        if name == 'client':
+            return (name, server, getattr(self, 'username', None))
+        return (name, server)
+
+    def get_validations(self):
+        # Sessions saved before validations were cached don't have them.
+        if getattr(self, 'validations', None) is None:
+            self.validations = {}
+        return self.validations
+
+    def is_invalid(self, name):
+        """Whether the client was last found to be invalid"""
+        result = self.get_validations().get(self.validation_key(name))
+        return result is not None and not result[1]
+
+    def invalidate(self, name):
+        """Record that a call of the client failed for its settings"""
+        self.get_validations()[self.validation_key(name)] = (time(), False)
+
+    def forget_validation(self, name):
+        self.get_validations().pop(self.validation_key(name), None)
+
+    def validate(self, name, ttl=0):
+        """
+        Validate the client of the given name unless it was validated less
+        than `ttl` seconds ago, and return whether it is valid. The result is
+        cached per server and username. None is returned, and nothing cached,
+        if the client couldn't be validated for some other reason.
+        """
+        key = self.validation_key(name)
+        result = self.get_validations().get(key)
+        if result is not None and time() - result[0] < ttl:
+            return result[1]
+        if name == 'client':
+            client = self.get_or_create_client()[0]
+        else:
+            client = self.get_or_create_public_client()[0]
+        try:
+            client.validate()
+        except ClientError:
+            valid = False
+        except Exception:
+            return None
+        else:
+            valid = True
+        self.get_validations()[key] = (time(), valid)
+        return valid
+
     def update_device(self):
+        """
+        Send the device name to the server if it was changed since it was last
+        sent. `device_updated` is set while it hasn't been sent.
+        """
+        if not getattr(self, 'device_updated', False) or not self.client:
+            return
         try:
             updated = self.client_.update_device_settings(
                 self.device_id,
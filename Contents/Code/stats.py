@@ -0,0 +1,112 @@
+from collections import deque
+
+from .plex_framework_api import Thread
+
+
+class Histogram(object):
+    """
+    The most recent samples of a measurement
+
+    Recording a sample only appends it to a bounded window. Percentiles are
+    computed over the window when asked for.
+    """
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.errors = 0
+
+    def record(self, value, error=False):
+        self.samples.append(value)
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class Stats(object):
+    """
+    Rolling histograms of route and outbound request times in seconds, counts
+    of the outbound requests made by each route, and hit counts of caches
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.routes = {}
+        self.requests = {}
+        self.calls = {}
+        self.caches = {}
+        self.lock = Thread.Lock()
+
+    def histogram(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.setdefault(name, Histogram(self.size))
+        return histogram
+
+    def record_route(self, name, seconds, error=False):
+        self.histogram(self.routes, name).record(seconds, error)
+
+    def record_request(self, kind, seconds, error=False, route=None):
+        self.histogram(self.requests, kind).record(seconds, error)
+        if route is not None:
+            with self.lock:
+                counts = self.calls.setdefault(route, {})
+                counts[kind] = counts.get(kind, 0) + 1
+
+    def record_cache(self, name, hit):
+        with self.lock:
+            counts = self.caches.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def cache_summary(self):
+        with self.lock:
+            caches = dict((k, list(v)) for k, v in self.caches.items())
+        return dict(
+            (name, {'hits': hits, 'misses': misses,
+                    'hit_ratio': float(hits) / (hits + misses)})
+            for name, (hits, misses) in caches.items()
+        )
+
+    def lines(self, caches=None):
+        """
+        Describe the stats a line per route, kind of request, route making
+        requests and cache,
+        including the summaries of other `caches` by name
+        """
+        lines = []
+        for title, histograms in (('route', self.routes),
+                                  ('requests', self.requests)):
+            for name, histogram in sorted(histograms.items()):
+                s = histogram.summary()
+                lines.append(
+                    '%s %s: %d calls, %d errors, p50 %.0fms, p95 %.0fms, '
+                    'p99 %.0fms' % (title, name, s['count'], s['errors'],
+                                    s['p50'] * 1000, s['p95'] * 1000,
+                                    s['p99'] * 1000)
+                )
+        with self.lock:
+            calls = sorted((route, sorted(counts.items()))
+                           for route, counts in self.calls.items())
+        for route, counts in calls:
+            lines.append('calls %s: %s' % (route, ', '.join(
+                '%d %s' % (count, kind) for kind, count in counts)))
+        summaries = self.cache_summary()
+        summaries.update(caches or {})
+        for name, s in sorted(summaries.items()):
+            lines.append('cache %s: %d hits, %d misses, %.0f%% hit ratio' % (
+                name, s['hits'], s['misses'], s['hit_ratio'] * 100))
+        return lines
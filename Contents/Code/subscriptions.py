@@ -0,0 +1,209 @@
+import re
+from bisect import bisect_left, insort
+
+from .plex_framework_api import Data, Log, Thread
+from .utils import decode, encode, podcast_to_dict
+
+
+# TODO: See if undocumented Plex Regex() can work
+TITLE_REGEX = re.compile(r'[^\w\d]|the\s')
+
+
+def title_key(title):
+    return TITLE_REGEX.sub('', (title or '').lower())
+
+
+class SubscriptionStore(object):
+    """
+    The user's subscribed podcasts, indexed on url and kept sorted on title
+
+    Membership tests, lookups and url renames don't scan the subscriptions,
+    and iterating over the store yields the podcasts in title order. Changes
+    are recorded until they are saved by a `SubscriptionJournal`.
+    """
+    def __init__(self, podcasts=()):
+        self.podcasts = {}
+        self.order = []
+        self.changes = []
+        self.seq = 0
+        for podcast in podcasts:
+            self.add(podcast)
+
+    def __contains__(self, url):
+        return url in self.podcasts
+
+    def __len__(self):
+        return len(self.podcasts)
+
+    def __iter__(self):
+        # Iterate over a copy so other threads can change the store meanwhile.
+        for _, url in list(self.order):
+            podcast = self.podcasts.get(url)
+            if podcast is not None:
+                yield podcast
+
+    def get(self, url, default=None):
+        return self.podcasts.get(url, default)
+
+    def add(self, podcast):
+        """Add a podcast, replacing the one with the same url if any"""
+        self.discard(podcast.url)
+        self.podcasts[podcast.url] = podcast
+        insort(self.order, (title_key(podcast.title), podcast.url))
+        self.changes.append({'op': 'add', 'podcast': podcast_to_dict(podcast)})
+
+    def remove(self, url):
+        """Remove and return the podcast with the given url if any"""
+        podcast = self.discard(url)
+        if podcast is not None:
+            self.changes.append({'op': 'remove', 'url': url})
+        return podcast
+
+    def rename(self, old_url, new_url):
+        """Change the url of a podcast"""
+        podcast = self.discard(old_url)
+        if podcast is not None:
+            self.discard(new_url)
+            podcast.url = new_url
+            self.podcasts[new_url] = podcast
+            insort(self.order, (title_key(podcast.title), new_url))
+            self.changes.append({'op': 'rename', 'old': old_url,
+                                 'new': new_url})
+        return podcast
+
+    def discard(self, url):
+        podcast = self.podcasts.pop(url, None)
+        if podcast is not None:
+            item = (title_key(podcast.title), url)
+            del self.order[bisect_left(self.order, item)]
+        return podcast
+
+    def apply(self, change):
+        """Replay a recorded change"""
+        if change['op'] == 'add':
+            from mygpoclient.simple import Podcast
+            self.add(Podcast.from_dict(change['podcast']))
+        elif change['op'] == 'remove':
+            self.remove(change['url'])
+        elif change['op'] == 'rename':
+            self.rename(change['old'], change['new'])
+
+
+class SubscriptionJournal(object):
+    """
+    Persists a SubscriptionStore as a snapshot and a journal of its changes
+
+    Every save writes only the changes made since the previous save as a new
+    journal entry, so its cost doesn't depend on the number of subscriptions.
+    Once enough changes have been journaled, they are compacted into a new
+    snapshot. Loading replays the journal on top of the snapshot and stops at
+    the first entry that can't be read. A snapshot that can't be read is
+    dropped and `unreadable` is set, so that the store is synced whole.
+
+    Each Data item is saved whole, so a crash while saving loses at most the
+    changes of that save.
+    """
+    def __init__(self, name='subscriptions', compact_after=200):
+        self.name = name
+        self.compact_after = compact_after
+        self.store = None
+        self.journaled = 0
+        self.unreadable = False
+        # Changes to the shared store and their saves must hold this lock.
+        self.lock = Thread.Lock()
+
+    def entry_key(self, seq):
+        return '%s_journal_%d' % (self.name, seq)
+
+    def exists(self):
+        return self.store is not None or Data.Exists(self.name)
+
+    def load(self):
+        """Get the store, reading it from the snapshot and journal once"""
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    self.store = self.read()
+        return self.store
+
+    def read(self):
+        store = None
+        if Data.Exists(self.name):
+            try:
+                store = Data.LoadObject(self.name)
+            except Exception as e:
+                Log.Warn('Unreadable subscriptions snapshot: %s', e)
+                Data.Remove(self.name)
+                self.unreadable = True
+        if not hasattr(store, 'seq'):
+            # Subscriptions used to be cached as a list.
+            store = SubscriptionStore(store or ())
+            store.changes = []
+
+        # Remove entries left over from an interrupted compaction.
+        seq = store.seq
+        while seq > 0 and Data.Exists(self.entry_key(seq)):
+            Data.Remove(self.entry_key(seq))
+            seq -= 1
+
+        self.journaled = 0
+        seq = store.seq + 1
+        while Data.Exists(self.entry_key(seq)):
+            try:
+                changes = decode(Data.Load(self.entry_key(seq)))
+            except Exception as e:
+                Log.Warn('Unreadable subscriptions journal entry %d: %s',
+                         seq, e)
+                break
+            for change in changes:
+                store.apply(change)
+            store.seq = seq
+            self.journaled += len(changes)
+            seq += 1
+        store.changes = []
+        return store
+
+    def save(self, store):
+        """Journal the changes of the store made since it was last saved"""
+        if store is not self.store:
+            # A store that isn't shared is saved whole.
+            self.store = store
+            store.changes = []
+            self.compact(store)
+            return
+        if not store.changes:
+            return
+        Data.Save(self.entry_key(store.seq + 1), encode(store.changes))
+        store.seq += 1
+        self.journaled += len(store.changes)
+        store.changes = []
+        if self.journaled >= self.compact_after or \
+                not Data.Exists(self.name):
+            self.compact(store)
+
+    def compact(self, store):
+        """Save a snapshot of the store and remove the journal behind it"""
+        Data.SaveObject(self.name, store)
+        seq = store.seq
+        while seq > 0 and Data.Exists(self.entry_key(seq)):
+            Data.Remove(self.entry_key(seq))
+            seq -= 1
+        self.journaled = 0
+
+    def clear(self):
+        """Remove the snapshot and the journal"""
+        with self.lock:
+            last = (self.store or self.read()).seq
+            # Include entries past the last one that could be read.
+            seq = last + 1
+            while Data.Exists(self.entry_key(seq)):
+                Data.Remove(self.entry_key(seq))
+                seq += 1
+            seq = last
+            while seq > 0 and Data.Exists(self.entry_key(seq)):
+                Data.Remove(self.entry_key(seq))
+                seq -= 1
+            if Data.Exists(self.name):
+                Data.Remove(self.name)
+            self.store = None
+            self.journaled = 0
@@ -1,6 +1,8 @@
-from mygpoclient.simple import Podcast
+from Queue import Empty, Queue
+from time import time
 
-from .plex_framework_api import AudioCodec, Container, Data, Dict, JSON
+from .plex_framework_api import (AudioCodec, Container, Data, Dict, JSON, Log,
+                                 Thread)
 
 
 def clear_cache(data_attrs=None, dict_items=None):
@@ -16,6 +18,75 @@ def clear_cache(data_attrs=None, dict_items=None):
     Dict.Save()
 
 
+def map_concurrently(func, items, workers=8, timeout=None, budget=None):
+    """
+    Call `func` on each of `items` from a bounded pool of worker threads.
+
+    Returns a tuple of the results of the successful calls (in the order of
+    `items`) and a list of the items whose calls failed. Calls still running
+    when no result has arrived for `timeout` seconds, or once `budget`
+    seconds have passed in total, are counted as failed.
+    """
+    deadline = time() + budget if budget is not None else None
+    items = list(items)
+    tasks = Queue()
+    for i, item in enumerate(items):
+        tasks.put((i, item))
+    done = Queue()
+
+    def work():
+        while True:
+            try:
+                i, item = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                done.put((i, True, func(item)))
+            except Exception as e:
+                Log.Warn('Call failed for %s: %s', item, e)
+                done.put((i, False, None))
+
+    for _ in range(min(workers, len(items))):
+        Thread.Create(work)
+
+    results = {}
+    for _ in items:
+        wait = timeout
+        if deadline is not None:
+            remaining = max(deadline - time(), 0)
+            wait = remaining if wait is None else min(wait, remaining)
+        try:
+            i, ok, result = done.get(timeout=wait)
+        except Empty:
+            break
+        if ok:
+            results[i] = result
+
+    # Anything left over either timed out or was never started.
+    while not tasks.empty():
+        try:
+            tasks.get_nowait()
+        except Empty:
+            break
+    return ([results[n] for n in sorted(results)],
+            [item for n, item in enumerate(items) if n not in results])
+
+
+def paginate(items, page_size):
+    """
+    Slice a list of items into a list of pages of the given size.
+    """
+    items = list(items)
+    return [items[i:i + page_size] for i in range(0, len(items), page_size)]
+
+
+def normalize_query(query):
+    """
+    Lower-case a search query and collapse its whitespace.
+    """
+    return ' '.join((query or '').lower().split())
+
+
 def encode(o):
     return JSON.StringFromObject(o)
 
@@ -25,6 +96,7 @@ def decode(s):
 
 
 def podcast_to_dict(obj):
+    from mygpoclient.simple import Podcast
     return {i: getattr(obj, i) for i in Podcast.REQUIRED_FIELDS}
 
 
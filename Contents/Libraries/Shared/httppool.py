@@ -0,0 +1,530 @@
+"""
+Keep-alive HTTP connection pooling for urllib2
+
+A Transport keeps idle connections per host and hands them to urllib2 through
+a handler, so consecutive requests to the same host reuse one TCP connection
+(and TLS session) instead of opening a new one each time.
+
+A Throttle limits the rate of requests to hosts that throttle them with a
+token bucket, and retries throttled requests after the time the server asks
+for or with a jittered exponential backoff.
+
+A CircuitBreaker refuses requests to hosts that failed repeatedly, so a dead
+host costs one error instead of a timeout per request.
+"""
+import email.utils
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+
+class PooledResponse(object):
+    """
+    The body of a response read from a pooled connection
+
+    The connection goes back to its pool once the body has been read in full,
+    or is closed if the body is abandoned or the server won't keep it alive.
+    """
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+        self.released = False
+        self.buffer = ''
+        self.check()
+
+    def check(self):
+        if not self.released and self.response.isclosed():
+            self.released = True
+            self.release(not self.response.will_close)
+
+    def read(self, amt=None):
+        if self.buffer:
+            if amt is None:
+                data, self.buffer = self.buffer + self.response.read(), ''
+            else:
+                data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        else:
+            data = self.response.read(amt)
+        self.check()
+        return data
+
+    def readline(self, limit=-1):
+        while '\n' not in self.buffer and not self.response.isclosed():
+            chunk = self.response.read(8192)
+            if not chunk:
+                break
+            self.buffer += chunk
+        self.check()
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.response.close()
+            self.release(False)
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    A urllib2 handler that opens HTTP and HTTPS requests through a Transport
+    """
+    # Run ahead of urllib2's own handlers when added to an existing opener.
+    handler_order = 400
+
+    def __init__(self, transport):
+        urllib2.AbstractHTTPHandler.__init__(self)
+        self.transport = transport
+
+    def http_open(self, req):
+        return self.transport.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.transport.do_open(httplib.HTTPSConnection, req)
+
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+
+class Throttle(object):
+    """
+    A token bucket per host that throttles requests, refilled with `rate`
+    tokens a second up to `burst` tokens
+
+    Requests to a host aren't limited until it answers one with 429 or 503.
+    From then on, every request takes a token, waiting for one if there are
+    none left. Throttled requests are retried up to `max_retries` times,
+    after the Retry-After of the response or else after a backoff doubling
+    from `backoff` seconds with random jitter. Until then, other requests to
+    the host wait as well. A request isn't retried if it would have to wait
+    longer than `max_wait` seconds.
+
+    The rate of a host drops by a quarter every time it throttles a request
+    again, and recovers by a tenth of `rate` with every request it doesn't.
+    Once it is back up to `max_rate` (eight times `rate` by default), the
+    host is no longer limited.
+    """
+    def __init__(self, rate=4.0, burst=8, max_retries=4, backoff=1.0,
+                 max_wait=10.0, max_rate=None):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate * 8)
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.waited = 0.0
+
+    def bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = {
+                'tokens': self.burst,
+                'updated': time.time(),
+                'blocked_until': 0,
+                # Not limited until the host throttles a request.
+                'rate': None,
+            }
+        return bucket
+
+    def acquire(self, host):
+        """Take a token for a request to the host, waiting for one"""
+        while True:
+            with self.lock:
+                bucket = self.bucket(host)
+                now = time.time()
+                wait = max(0, bucket['blocked_until'] - now)
+                taken = not wait
+                if taken and bucket['rate'] is not None:
+                    bucket['tokens'] = min(
+                        self.burst, bucket['tokens'] +
+                        (now - bucket['updated']) * bucket['rate'])
+                    bucket['updated'] = now
+                    # Taking a token ahead of time keeps waiting requests in
+                    # order.
+                    bucket['tokens'] -= 1
+                    wait = max(0, -bucket['tokens'] / bucket['rate'])
+                self.waited += wait
+            if wait > 0:
+                time.sleep(wait)
+            if taken:
+                return
+
+    def delay(self, headers, retries):
+        """
+        Get the seconds to wait before the given retry of a throttled request
+        """
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            if retry_after.strip().isdigit():
+                return float(retry_after)
+            date = email.utils.parsedate_tz(retry_after)
+            if date is not None:
+                return max(0.0, email.utils.mktime_tz(date) - time.time())
+        return self.backoff * 2 ** retries * random.uniform(0.5, 1.0)
+
+    def block(self, host, seconds):
+        """Hold back requests to the host for the given seconds"""
+        with self.lock:
+            self.throttled += 1
+            bucket = self.bucket(host)
+            bucket['blocked_until'] = max(bucket['blocked_until'],
+                                          time.time() + seconds)
+            if bucket['rate'] is None:
+                bucket['rate'] = self.rate
+                bucket['tokens'] = 0
+                bucket['updated'] = time.time()
+            else:
+                bucket['tokens'] = min(bucket['tokens'], 0)
+                bucket['rate'] = max(self.rate / 16, bucket['rate'] * 0.75)
+
+    def succeeded(self, host):
+        with self.lock:
+            bucket = self.bucket(host)
+            if bucket['rate'] is not None:
+                bucket['rate'] += self.rate / 10
+                if bucket['rate'] >= self.max_rate:
+                    bucket['rate'] = None
+
+    def stats(self):
+        return {'throttled': self.throttled, 'waited': self.waited}
+
+
+class ThrottleHandler(urllib2.BaseHandler):
+    """
+    A urllib2 handler that limits and retries requests with a Throttle
+    """
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def http_request(self, req):
+        self.throttle.acquire(req.get_host())
+        return req
+
+    def http_response(self, req, response):
+        if response.code not in (429, 503):
+            self.throttle.succeeded(req.get_host())
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+    def retry(self, req, fp, code, msg, headers):
+        retries = getattr(req, 'throttle_retries', 0)
+        delay = self.throttle.delay(headers, retries)
+        self.throttle.block(req.get_host(), delay)
+        if retries >= self.throttle.max_retries or \
+                delay > self.throttle.max_wait:
+            return None
+        fp.read()
+        fp.close()
+        req.throttle_retries = retries + 1
+        return self.parent.open(req, timeout=req.timeout)
+
+    http_error_429 = http_error_503 = retry
+
+
+class CircuitOpen(urllib2.URLError):
+    """A request refused because the circuit of its host is open"""
+    def __init__(self, host):
+        urllib2.URLError.__init__(self, 'circuit open for %s' % host)
+        self.host = host
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker per host
+
+    A host's circuit opens after `failures` consecutive failed requests
+    (connection errors, timeouts and 5xx responses), and requests to it are
+    refused with CircuitOpen for `reset_time` seconds. Then a single request
+    is let through as a probe (the circuit is half-open): if it succeeds the
+    circuit closes, otherwise it opens again for twice as long, up to
+    `max_reset_time` seconds.
+
+    If given, `observer` is called with the host and its new state whenever
+    a circuit opens or closes.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset_time=30.0, max_reset_time=600.0,
+                 observer=None):
+        self.failures = failures
+        self.reset_time = reset_time
+        self.max_reset_time = max_reset_time
+        self.observer = observer
+        self.circuits = {}
+        self.lock = threading.Lock()
+        self.trips = 0
+        self.refused = 0
+
+    def circuit(self, host):
+        circuit = self.circuits.get(host)
+        if circuit is None:
+            circuit = self.circuits[host] = {
+                'state': self.CLOSED,
+                'failures': 0,
+                'opened': 0,
+                'reset_time': self.reset_time,
+                'trips': 0,
+            }
+        return circuit
+
+    def allow(self, host):
+        """Raise CircuitOpen unless a request to the host may be made"""
+        with self.lock:
+            circuit = self.circuit(host)
+            if circuit['state'] == self.OPEN and \
+                    time.time() - circuit['opened'] >= circuit['reset_time']:
+                circuit['state'] = self.HALF_OPEN
+                return
+            if circuit['state'] != self.CLOSED:
+                self.refused += 1
+                raise CircuitOpen(host)
+
+    def record(self, host, error):
+        """Record the outcome of a request allowed to the host"""
+        with self.lock:
+            circuit = self.circuit(host)
+            state = circuit['state']
+            if not error:
+                circuit.update(state=self.CLOSED, failures=0,
+                               reset_time=self.reset_time)
+            elif state == self.HALF_OPEN:
+                circuit.update(state=self.OPEN, opened=time.time(),
+                               reset_time=min(self.max_reset_time,
+                                              circuit['reset_time'] * 2))
+            else:
+                circuit['failures'] += 1
+                if state == self.CLOSED and \
+                        circuit['failures'] >= self.failures:
+                    circuit.update(state=self.OPEN, opened=time.time())
+                    circuit['trips'] += 1
+                    self.trips += 1
+            changed = circuit['state'] if circuit['state'] != state else None
+        if changed is not None and self.observer is not None:
+            try:
+                self.observer(host, changed)
+            except Exception:
+                pass
+
+    def states(self):
+        """Get the state and trip count of every host that ever tripped"""
+        with self.lock:
+            return dict((host, (c['state'], c['trips']))
+                        for host, c in self.circuits.items() if c['trips'])
+
+    def stats(self):
+        return {'trips': self.trips, 'refused': self.refused}
+
+
+class Context(threading.local):
+    """
+    The state of the current thread: the route it serves, if any. `bind`
+    carries the state of the calling thread over to the thread running the
+    function it returns.
+    """
+    route = None
+
+    def bind(self, func):
+        route = self.route
+
+        def bound(*args, **kwargs):
+            self.route = route
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.route = None
+        return bound
+
+
+class Transport(object):
+    """
+    A pool of keep-alive connections per host, shared between threads
+
+    New connections give up after `connect_timeout` seconds, and requests
+    after waiting `timeout` seconds for data, unless they set a timeout of
+    their own.
+
+    If given, `observer` is called with the host, the seconds until the
+    response headers arrived and whether the request failed, after every
+    request not opened with `defer`, whose caller times its body itself. The
+    route each thread serves is kept in `context` for observers. Requests of
+    mygpoclient clients are limited by `throttle` if given, and requests made
+    with `open` are refused by `breaker` if given.
+    """
+    def __init__(self, max_idle=4, timeout=None, observer=None,
+                 throttle=None, breaker=None, connect_timeout=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.observer = observer
+        self.throttle = throttle
+        self.breaker = breaker
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.opener = urllib2.build_opener(KeepAliveHandler(self))
+        self.client_classes = {}
+        self.context = Context()
+
+    def open(self, request, timeout=None, defer=False):
+        """
+        Open a url or urllib2.Request like urllib2.urlopen. With `defer`, the
+        breaker isn't told the request succeeded until `report` is called
+        once the body has been read, and the observer isn't called.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if not isinstance(request, urllib2.Request):
+            request = urllib2.Request(request)
+        request.observed = not defer
+        if self.breaker is None:
+            return self.open_request(request, timeout)
+
+        host = request.get_host()
+        self.breaker.allow(host)
+        try:
+            response = self.open_request(request, timeout)
+        except urllib2.HTTPError as e:
+            self.breaker.record(host, e.code >= 500)
+            raise
+        except Exception:
+            self.breaker.record(host, True)
+            raise
+        if not defer:
+            self.breaker.record(host, False)
+        return response
+
+    def report(self, url, error):
+        """
+        Tell the breaker whether reading the body of a response opened with
+        `defer` failed
+        """
+        if self.breaker is not None:
+            self.breaker.record(urllib2.Request(url).get_host(), error)
+
+    def open_request(self, request, timeout):
+        if timeout is None:
+            return self.opener.open(request)
+        return self.opener.open(request, timeout=timeout)
+
+    def client_class(self, base):
+        """
+        Get a subclass of a mygpoclient HttpClient class that sends its
+        requests through this transport, and its throttle if any.
+        """
+        if base not in self.client_classes:
+            transport = self
+
+            class PooledClient(base):
+                def __init__(self, *args, **kwargs):
+                    base.__init__(self, *args, **kwargs)
+                    self._opener.add_handler(KeepAliveHandler(transport))
+                    if transport.throttle is not None:
+                        self._opener.add_handler(
+                            ThrottleHandler(transport.throttle))
+
+            self.client_classes[base] = PooledClient
+        return self.client_classes[base]
+
+    def acquire(self, key):
+        with self.lock:
+            idle = self.pools.get(key)
+            if idle:
+                return idle.pop(), True
+        return None, False
+
+    def release(self, key, conn, reusable):
+        if reusable:
+            with self.lock:
+                idle = self.pools.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+    def observe(self, req, start, error):
+        if self.observer is not None and getattr(req, 'observed', True):
+            try:
+                self.observer(req.get_host(), time.time() - start, error)
+            except Exception:
+                pass
+
+    def do_open(self, connection_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (connection_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((k.title(), v) for k, v in headers.items())
+
+        # The timeout of the request, else of the transport, else the default.
+        timeout = req.timeout
+        if not isinstance(timeout, (int, float)):
+            timeout = self.timeout
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        connect_timeout = self.connect_timeout
+        if connect_timeout is None:
+            connect_timeout = timeout
+
+        conn, reused = self.acquire(key)
+        start = time.time()
+        while True:
+            try:
+                if conn is None:
+                    conn = connection_class(host, timeout=connect_timeout)
+                    conn.connect()
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # A timeout is the host's fault, not the idle connection's.
+                if not reused or isinstance(e, socket.timeout):
+                    self.observe(req, start, True)
+                    raise urllib2.URLError(e)
+                # The server closed the idle connection; use a new one.
+                conn, reused = None, False
+        # Authentication challenges are answered by urllib2 with a retry.
+        self.observe(req, start,
+                     response.status >= 400 and response.status != 401)
+
+        if response.length == 0:
+            response.read()
+
+        def release(reusable):
+            self.release(key, conn, reusable)
+
+        fp = PooledResponse(response, release)
+        resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp